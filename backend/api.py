@@ -9,7 +9,8 @@ API — Klint GPT v3
 
 from __future__ import annotations
 
-import base64, logging, tiktoken, mimetypes
+import os, asyncio, logging, threading, tiktoken
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from typing import Optional, List, Tuple, Iterable
 
@@ -25,20 +26,27 @@ from fastapi.responses import StreamingResponse, JSONResponse, FileResponse
 
 from backend.auth  import get_current_user
 from backend.db    import (
-    create_conversation, get_conversation, update_conversation,
+    create_conversation, get_conversation, update_conversation, commit_summary,
     list_conversations, delete_conversation,
     create_project,     list_projects,     delete_project,
     get_project,        update_project,
 )
 from backend.model import (
-    azure_llm_chat, azure_llm_chat_stream,
-    gpt4o_ocr, dalle3_generate,
+    azure_llm_chat, azure_llm_chat_async, azure_llm_chat_stream_async,
+    gpt4o_ocr_async, dalle3_generate_async,
 )
-from backend.model import RAW_MODELS, _requires_vision
-from backend.models import (
-    parse_pdf, parse_docx, parse_txt, parse_excel,
-    get_text_chunks, build_vectorstore_from_texts,
-    search_documents, summarize_text,
+from backend.model import RAW_MODELS, _requires_vision, deployment_status
+from backend.model import TOKEN_ENCODER, message_tokens, _count_prompt_tokens
+from backend.model import MESSAGE_OVERHEAD, prompt_budget
+from backend.packer import Piece, pack, drop_report
+from backend.ingest import ingest_files
+from backend.models import answer_from_tables_async
+from backend.cache import cache_stats
+from backend.hedge import hedger
+from backend.singleflight import flight_stats
+from backend.scheduler import scheduler, priority, bind
+from backend.vectorstore import (
+    build_vectorstore, search_documents, project_store,
 )
 
 # ───────────────────────────── Logger
@@ -68,92 +76,212 @@ SUM_SYSTEM = (
 )
 
 def _ntokens(txt: str) -> int:
-    return len(ENC.encode(txt))
+    return len(ENC.encode(txt, disallowed_special=()))
 
-def _ensure_summary(conv: dict) -> None:
+# Comptes de jetons : chaque message garde le sien (model.message_tokens) et
+# conv["token_count"] tient le total courant – seuls les messages ajoutés
+# depuis le dernier tour sont comptés (rattrapage auto des anciennes conv.).
+def _conv_tokens(conv: dict) -> int:
+    """Total résumé + messages, mis à jour incrémentalement."""
     msgs = conv.get("messages", [])
+    tc   = conv.get("token_count")
+    if not tc or tc.get("encoder") != TOKEN_ENCODER or tc.get("n", 0) > len(msgs):
+        tc = conv["token_count"] = {"encoder": TOKEN_ENCODER, "n": 0, "messages": 0}
+    if tc.get("summary_index") != conv.get("summary_index", 0) or "summary" not in tc:
+        tc["summary"]       = _ntokens(conv.get("summary", ""))    # résumé changé
+        tc["summary_index"] = conv.get("summary_index", 0)
+    for m in msgs[tc["n"]:]:
+        tc["messages"] += message_tokens(m)
+    tc["n"] = len(msgs)
+    return tc["summary"] + tc["messages"]
+
+def _append_message(conv: dict, msg: dict) -> None:
+    conv["messages"].append(msg)
+    _conv_tokens(conv)
+
+# Résumé en tâche de fond, après l’enregistrement de la réponse : la requête
+# suivante prend le résumé disponible, sans jamais l’attendre. Une tâche par
+# conversation (ce process) ; entre workers, db.commit_summary n’accepte que
+# le premier résumé calculé sur un summary_index donné.
+_summary_pool    = ThreadPoolExecutor(max_workers=2, thread_name_prefix="conv-summary")
+_summary_lock    = threading.Lock()
+_summarizing: set[str] = set()
+
+def _summary_cut(conv: dict) -> int | None:
+    """Fin de la tranche à résumer, ou None si rien à faire (O(1))."""
     done = conv.get("summary_index", 0)
-    total = _ntokens(conv.get("summary", "")) + sum(_ntokens(m["content"]) for m in msgs)
-    if total <= TOK_LIMIT:
-        return
+    cut  = max(done, len(conv.get("messages", [])) - KEEP_LAST)
+    if _conv_tokens(conv) <= TOK_LIMIT or cut <= done:
+        return None
+    return cut
 
-    cut   = max(done, len(msgs) - KEEP_LAST)
-    older = msgs[done:cut]
-    if not older:
+def _schedule_summary(conv: dict) -> None:
+    if _summary_cut(conv) is None:
         return
-
-    to_sum  = "\n\n".join(f"{m['role']}: {m['content']}" for m in older)
-    summary = azure_llm_chat(
-        [
-            {"role": "system", "content": SUM_SYSTEM},
-            {"role": "user",   "content": to_sum},
-        ],
-        model=SUM_MODEL,
-    )[0]
-    conv["summary"]       = (conv.get("summary", "") + "\n\n" + summary).strip()
-    conv["summary_index"] = cut
-    update_conversation(conv)
+    with _summary_lock:
+        if conv["id"] in _summarizing:
+            return
+        _summarizing.add(conv["id"])
+    with priority("background"):
+        _summary_pool.submit(bind(_summarize_conversation), conv["entra_oid"], conv["id"])
+
+def _summarize_conversation(uid: str, conv_id: str) -> None:
+    try:
+        conv = get_conversation(uid, conv_id)          # état frais
+        cut  = _summary_cut(conv) if conv else None
+        if cut is None:
+            return
+        done   = conv.get("summary_index", 0)
+        to_sum = "\n\n".join(f"{m['role']}: {m['content']}" for m in conv["messages"][done:cut])
+        summary = azure_llm_chat(
+            [
+                {"role": "system", "content": SUM_SYSTEM},
+                {"role": "user",   "content": to_sum},
+            ],
+            model=SUM_MODEL, hedge=True, cache="exact",
+        )[0]
+        summary = (conv.get("summary", "") + "\n\n" + summary).strip()
+        if not commit_summary(uid, conv_id, done, summary, cut):
+            logger.info("Résumé %s obsolète (summary_index a bougé) : ignoré", conv_id)
+    except Exception:
+        logger.exception("Résumé de la conversation %s", conv_id)
+    finally:
+        with _summary_lock:
+            _summarizing.discard(conv_id)
 
 # ───────────────────────────── Prompt builder & helper
+#  Le prompt est rempli par priorité dans le budget du modèle (packer.py) :
+#  règles système, question → tours récents → tableaux / passages RAG →
+#  résumés (conversation, documents) → tours plus anciens.
+RECENT_TURNS = int(os.getenv("PROMPT_RECENT_TURNS", "6"))
+
+CODE_RULE = "Si ta réponse contient du code, encadre-le **obligatoirement** avec ```lang … ```."
+WEB_RULE  = (
+    "\n\nTu as le droit d'utiliser l'outil `web.run` pour faire des recherches "
+    "sur Internet quand c'est pertinent. "
+    "Cite toujours tes sources avec le format demandé."
+)
+
+def _model_rule(model_name: str) -> str:
+    return (
+        f"Tu es le modèle **{model_name}**. "
+        "Si l’utilisateur demande quel modèle tu es, "
+        "réponds ce nom, et surtout de ne pas oublier de dire que tu es un assistant virtuel à la disposition de ses utilisateurs."
+    )
+
+def _assemble(conv: dict, question: str, context: dict, model_name: str | None,
+              history: list[dict], kept: list[Piece]) -> Tuple[list[dict], int]:
+    """Prompt à partir des morceaux gardés (ordre d’origine) + taille exacte."""
+    by: dict[str, list] = {}
+    for p in kept:
+        by.setdefault(p.section, []).append(p.value)
+
+    base_sys  = ""
+    overviews = [v for k, v in by.get("summaries", []) if k == "doc"]
+    if context.get("instructions"):
+        base_sys += f"Project instructions:\n{context['instructions']}\n\n"
+    if overviews:
+        base_sys += "Document overviews:\n" + "\n\n".join(overviews) + "\n\n"
+    if by.get("tables"):
+        base_sys += f"Table query results:\n{by['tables'][0]}\n\n"
+    if by.get("passages"):
+        base_sys += "Context passages:\n" + "\n\n".join(by["passages"])
+    if context.get("web"):
+        base_sys += WEB_RULE
+
+    head = [{"role": "system", "content": CODE_RULE}]
+    if base_sys.strip():
+        head.append({"role": "system", "content": base_sys.strip()})
+    if model_name:
+        head.append({"role": "system", "content": _model_rule(model_name)})
+    if any(k == "conv" for k, _ in by.get("summaries", [])):
+        head.append({"role": "system", "content": "Résumé de la conversation :\n" + conv["summary"]})
+
+    turns    = [history[i] for i in sorted(by.get("recent", []) + by.get("older", []))]
+    question_msg = {"role": "user", "content": question}
+    n_tokens = _count_prompt_tokens(head + [question_msg]) + _count_prompt_tokens(turns)
+    prompt   = head + [{k: v for k, v in m.items() if k != "tokens"} for m in turns] + [question_msg]
+    return prompt, n_tokens
+
 def _build_prompt(
     conv: dict,
     question: str,
-    base_sys: str,
+    context: dict,
     model_name: str | None = None,        
-) -> list[dict]:
+    budget: int | None = None,
+) -> Tuple[list[dict], int, dict]:
     """
-    Construit la liste complète « messages » à envoyer au LLM.
+    Construit la liste complète « messages » à envoyer au LLM, dans `budget`
+    jetons. Retourne (prompt, taille en jetons, rapport du packer).
 
-    - base_sys      : contexte système commun (instructions projet, RAG, etc.)
+    - context       : {"instructions", "overviews": [..], "tables", "passages": [..], "web"}
     - model_name    : si présent, ajoute une consigne précisant le modèle à annoncer
+    - budget        : défaut = prompt_budget(model_name)
     """
-    _ensure_summary(conv)
-
-    prompt: list[dict] = []
+    _conv_tokens(conv)
+    if budget is None:
+        budget = prompt_budget(model_name or "GPT 4o")
 
-    # ─── 1. contexte  ─────────────────────────────────────────────
-    if base_sys:
-        prompt.append({"role": "system", "content": base_sys.strip()})
-
-    prompt.insert(0,{
-        "role":"system",
-        "content":"Si ta réponse contient du code, encadre-le **obligatoirement** avec ```lang … ```."
-    })
-
-    # ─── 2. (optionnel) indiquer explicitement le modèle choisi ──
-    if model_name:
-        prompt.append({
-            "role": "system",
-            "content": (
-                f"Tu es le modèle **{model_name}**. "
-                "Si l’utilisateur demande quel modèle tu es, "
-                "réponds ce nom, et surtout de ne pas oublier de dire que tu es un assistant virtuel à la disposition de ses utilisateurs."
-            )
-        })
-
-    # ─── 3. résumé de la conversation ────────────────────────────
+    # la question vient d’être ajoutée à la conversation : pas de doublon
+    msgs = conv.get("messages", [])
+    if msgs and msgs[-1].get("role") == "user" and msgs[-1].get("content") == question:
+        msgs = msgs[:-1]
+    history = msgs[-KEEP_LAST:]
+
+    # ─── morceaux par priorité décroissante
+    required, _ = _assemble(conv, question, {**context, "overviews": [], "passages": []},
+                            model_name, [], [])
+    pieces = [Piece("rules", _count_prompt_tokens(required) + 2 * MESSAGE_OVERHEAD, required=True)]
+    n_recent = min(RECENT_TURNS, len(history))
+    for i in range(len(history) - 1, -1, -1):
+        section = "recent" if i >= len(history) - n_recent else "older"
+        pieces.append(Piece(section, message_tokens(history[i]) + MESSAGE_OVERHEAD, i, chain="turns"))
+    if context.get("tables"):
+        pieces.append(Piece("tables", _ntokens(context["tables"]) + 4, context["tables"]))
+    for passage in context.get("passages", []):
+        pieces.append(Piece("passages", _ntokens(passage) + 2, passage))
     if conv.get("summary"):
-        prompt.append({
-            "role": "system",
-            "content": "Résumé de la conversation :\n" + conv["summary"]
-        })
-
-    # ─── 4. historique + nouvelle question ───────────────────────
-    prompt += conv.get("messages", [])[-KEEP_LAST:]
-    prompt.append({"role": "user", "content": question})
-
-    return prompt
+        pieces.append(Piece("summaries", conv["token_count"]["summary"] + 8 + MESSAGE_OVERHEAD,
+                            ("conv", conv["summary"])))
+    for overview in context.get("overviews", []):
+        pieces.append(Piece("summaries", _ntokens(overview) + 2, ("doc", overview)))
+    # tours récents d’abord, puis le reste dans l’ordre de priorité demandé
+    order = {"rules": 0, "recent": 1, "tables": 2, "passages": 3, "summaries": 4, "older": 5}
+    pieces.sort(key=lambda p: order[p.section])
+
+    kept, report = pack(pieces, budget)
+
+    # ─── vérification sur le prompt final (jointures) : on retire au besoin
+    prompt, n_tokens = _assemble(conv, question, context, model_name, history, kept)
+    while n_tokens > budget and any(not p.required for p in kept):
+        victim = [p for p in kept if not p.required][-1]
+        kept.remove(victim)
+        d = report["dropped"].setdefault(victim.section, {"count": 0, "tokens": 0})
+        d["count"]  += 1
+        d["tokens"] += victim.tokens
+        prompt, n_tokens = _assemble(conv, question, context, model_name, history, kept)
+    report.update(used=n_tokens, over=n_tokens > budget)
+
+    if report["dropped"]:
+        logger.info("Prompt %s : %d/%d jetons, abandonnés %s",
+                    conv.get("id"), n_tokens, budget, drop_report(report))
+    return prompt, n_tokens, report
+
+def _prompt_headers(report: dict) -> dict:
+    """x-prompt-tokens (utilisés / budget) + x-prompt-dropped si le packer a coupé."""
+    out = {"x-prompt-tokens": f"{report['used']}/{report['budget']}"}
+    if report["dropped"]:
+        out["x-prompt-dropped"] = drop_report(report)
+    return out
 
 IMG_EXT = {"jpg","jpeg","png","gif","webp","bmp","svg"}
 
-def _prepare_conversation(req, uid: str) -> Tuple[dict, Iterable[dict]]:
+def _load_context(req, uid: str) -> Tuple[dict, dict, list[dict]]:
     """
-    Charge ou crée la conversation, ajoute le prompt utilisateur,
-    construit le tableau complet « messages » à envoyer au LLM.
+    Partie bloquante de la préparation (Cosmos, RAG) : charge ou crée la
+    conversation, ajoute le prompt utilisateur et rassemble le contexte.
+    Retourne (conversation, contexte sans les tableaux, documents).
     """
-    # ── 1. modèle demandé (défaut GPT 4o) ───────────────────────────────
-    chosen_model = req.modelId or "GPT 4o"
-
     # ───── récup / création ─────────────────────────────────────────
     if req.conversationId:
         conv = get_conversation(uid, req.conversationId)
@@ -173,7 +301,7 @@ def _prepare_conversation(req, uid: str) -> Tuple[dict, Iterable[dict]]:
                 for d in conv["documents"]
             ]
 
-        conv["messages"].append(msg)
+        _append_message(conv, msg)
         update_conversation(conv)
 
     else:
@@ -194,6 +322,7 @@ def _prepare_conversation(req, uid: str) -> Tuple[dict, Iterable[dict]]:
 
     # ───── contexte (instr + docs + RAG) ────────────────────────────
     instr, all_docs = conv.get("instructions",""), conv.get("documents",[])[:]
+    proj = None
 
     if conv.get("project_id"):
         proj = get_project(uid, conv["project_id"])
@@ -202,32 +331,44 @@ def _prepare_conversation(req, uid: str) -> Tuple[dict, Iterable[dict]]:
             if not instr:
                 instr = proj.get("instructions","")
 
-    doc_summaries = "\n\n".join(
+    doc_summaries = [
         f"### {d['name']}\n{d.get('summary','')}" for d in all_docs if d.get("summary")
-    )
+    ]
 
-    rag_context = ""
+    rag_passages: list[str] = []
     if all_docs and req.question.strip():
-        chunks = get_text_chunks("\n".join(d["content"] for d in all_docs))
-        vs     = build_vectorstore_from_texts(chunks)
-        rag_context = "\n\n".join(search_documents(vs, req.question, k=4))
-
-    base_sys = ""
-    if instr:         base_sys += f"Project instructions:\n{instr}\n\n"
-    if doc_summaries: base_sys += f"Document overviews:\n{doc_summaries}\n\n"
-    if rag_context:   base_sys += f"Context passages:\n{rag_context}"
-
-    # ─── navigation Web autorisée ? ──────────────────────────────
-    if getattr(req, "useWeb", False):
-        base_sys += (
-            "\n\nTu as le droit d'utiliser l'outil `web.run` pour faire des recherches "
-            "sur Internet quand c'est pertinent. "
-            "Cite toujours tes sources avec le format demandé."
-        )
+        # index construits à l’upload : seule la question est vectorisée.
+        # Le projet a son propre index (snapshot partagé par ses conversations).
+        vs = build_vectorstore(conv.get("documents", []))
+        if proj:
+            vs = vs + project_store(proj)
+        rag_passages = search_documents(vs, req.question, k=4)
+
+    context = {
+        "instructions": instr,
+        "overviews":    doc_summaries,
+        "tables":       "",
+        "passages":     rag_passages,
+        "web":          getattr(req, "useWeb", False),    # navigation Web autorisée ?
+    }
+    return conv, context, all_docs
+
+async def _prepare_conversation(req, uid: str) -> Tuple[dict, Iterable[dict], str, int | None, dict]:
+    """
+    Construit le tableau complet « messages » à envoyer au LLM
+    (+ sa taille en jetons, None si la passe vision l’a modifié,
+    + le rapport du packer). Cosmos / RAG / packer passent par le threadpool,
+    les appels LLM (plans tableaux, passe vision) sont attendus sur la boucle.
+    """
+    # ── 1. modèle demandé (défaut GPT 4o) ───────────────────────────────
+    chosen_model = req.modelId or "GPT 4o"
+    conv, context, all_docs = await asyncio.to_thread(_load_context, req, uid)
 
-    prompt = _build_prompt(conv, req.question, base_sys, model_name=chosen_model)
+    # tableaux (CSV / Excel) : requête pandas locale, seul le résultat est injecté
+    if req.question.strip() and any(d.get("table") for d in all_docs):
+        context["tables"] = await answer_from_tables_async(all_docs, req.question)
 
-    # ── 4. Vision : convertit les attachments ----------------------------------
+    # ── images : la passe vision (GPT-4o) reçoit le même prompt -----------------
     last_msg = conv["messages"][-1]
     img_atts = [
         a for a in last_msg.get("attachments", [])
@@ -235,6 +376,14 @@ def _prepare_conversation(req, uid: str) -> Tuple[dict, Iterable[dict]]:
             or a["name"].split(".")[-1].lower() in IMG_EXT)
         and a.get("url")
     ]
+    budget = prompt_budget(chosen_model)
+    if img_atts:
+        budget = min(budget, prompt_budget("GPT 4o"))
+
+    prompt, prompt_tokens, report = await asyncio.to_thread(
+        _build_prompt, conv, req.question, context, model_name=chosen_model, budget=budget)
+
+    # ── 4. Vision : convertit les attachments ----------------------------------
     if img_atts:
         prompt[-1]["content"] = (
             [{"type": "text", "text": req.question}] +
@@ -243,10 +392,12 @@ def _prepare_conversation(req, uid: str) -> Tuple[dict, Iterable[dict]]:
 
     # ── 5. 2-passes : si images + modèle ≠ 4o → GPT-4o d’abord ------------------
     if _requires_vision(prompt) and chosen_model != "GPT 4o":
-        vision_txt, _ = azure_llm_chat(prompt, model="GPT 4o")
-        prompt[-1]["content"] = vision_txt  
+        vision_txt, _ = await azure_llm_chat_async(prompt, model="GPT 4o", hedge=True,
+                                                   cache="exact")
+        prompt[-1]["content"] = vision_txt
+        prompt_tokens = None                      # question remplacée : recompte
 
-    return conv, prompt, chosen_model
+    return conv, prompt, chosen_model, prompt_tokens, report
 
 # ───────────────────────────── Schemas
 from pydantic import BaseModel
@@ -321,7 +472,7 @@ async def ocr_image(
     user: dict = Depends(get_current_user),
 ):
     content = await file.read()
-    text = gpt4o_ocr(content, file.content_type or "image/png")
+    text = await gpt4o_ocr_async(content, file.content_type or "image/png")
     return {"text": text}
 
 # ───────────────────────────── Génération image (DALL·E-3)
@@ -332,15 +483,15 @@ async def dalle_generate(req: Request, user: dict = Depends(get_current_user)):
     size        = data.get("size",  "1024x1024")
     conv_id_in  = data.get("conversationId")        # ← peut être None
 
-    url = dalle3_generate(prompt, size=size)
+    url = await dalle3_generate_async(prompt, size=size)
 
     # ── persistance ───────────────────────────────────────────────
     def _save_to_conv(conv: dict) -> None:
         # ① message user
         if prompt.strip():
-            conv["messages"].append({"role": "user", "content": prompt})
+            _append_message(conv, {"role": "user", "content": prompt})
         # ② réponse du bot = pièce jointe image
-        conv["messages"].append({
+        _append_message(conv, {
             "role": "assistant",
             "content": "",                     
             "attachments": [{
@@ -351,52 +502,64 @@ async def dalle_generate(req: Request, user: dict = Depends(get_current_user)):
         })
         update_conversation(conv)
 
-    # conversation existante fournie
-    if conv_id_in:
-        conv = get_conversation(user["entra_oid"], conv_id_in)
-        if conv: _save_to_conv(conv)
-        conv_id_out = conv_id_in
-    # sinon on crée un nouveau chat « image »
-    else:
+    def _persist() -> str:
+        # conversation existante fournie
+        if conv_id_in:
+            conv = get_conversation(user["entra_oid"], conv_id_in)
+            if conv: _save_to_conv(conv)
+            return conv_id_in
+        # sinon on crée un nouveau chat « image »
         conv = create_conversation(user["entra_oid"], prompt, conversation_type="chat")
         _save_to_conv(conv)
-        conv_id_out = conv["id"]
+        return conv["id"]
 
+    conv_id_out = await asyncio.to_thread(_persist)      # Cosmos : hors boucle
     return {"url": url, "conversationId": conv_id_out}
 
 
 # ───────────────────────────── /chat  (réponse complète)
+#  Handlers async : les appels LLM (réponse, plans tableaux, passe vision) ne
+#  bloquent aucun thread ; seuls Cosmos, le RAG et le packer passent par le
+#  threadpool (cf. _prepare_conversation).
 @router.post("/chat", response_model=ChatResponse)
-def chat_endpoint(req: ChatRequest, user: dict = Depends(get_current_user)):
+async def chat_endpoint(req: ChatRequest, user: dict = Depends(get_current_user)):
     uid = user["entra_oid"]
-    conv, prompt, chosen = _prepare_conversation(req, uid)
+    conv, prompt, chosen, n_tokens, report = await _prepare_conversation(req, uid)
 
-    answer, llm_headers   = azure_llm_chat(prompt, model=chosen)
+    answer, llm_headers   = await azure_llm_chat_async(prompt, model=chosen,
+                                                       prompt_tokens=n_tokens)
 
-    conv["messages"].append({"role": "assistant", "content": answer})
-    update_conversation(conv)
+    _append_message(conv, {"role": "assistant", "content": answer})
+    await asyncio.to_thread(update_conversation, conv)
+    _schedule_summary(conv)
 
-    headers = {"x-conversation-id": conv["id"], **llm_headers}
+    headers = {"x-conversation-id": conv["id"], **_prompt_headers(report), **llm_headers}
     return JSONResponse({"answer": answer, "conversationId": conv["id"]}, headers=headers)
 
 # ───────────────────────────── /chat/stream
 @router.post("/chat/stream")
-def chat_stream(req: ChatRequest, user: dict = Depends(get_current_user)):
+async def chat_stream(req: ChatRequest, user: dict = Depends(get_current_user)):
     uid = user["entra_oid"]
-    conv, prompt, chosen = _prepare_conversation(req, uid)
+    conv, prompt, chosen, n_tokens, report = await _prepare_conversation(req, uid)
 
-    gen, llm_headers = azure_llm_chat_stream(prompt, model=chosen)
+    gen, llm_headers = await azure_llm_chat_stream_async(prompt, model=chosen,
+                                                         prompt_tokens=n_tokens)
 
-    def wrapper():
+    async def wrapper():
         buffer = ""
         try:
-            for delta in gen:
+            async for delta in gen:
                 buffer += delta
                 yield delta
-            conv["messages"].append({"role": "assistant", "content": buffer})
-            update_conversation(conv)
+            _append_message(conv, {"role": "assistant", "content": buffer})
+            await asyncio.to_thread(update_conversation, conv)
+            _schedule_summary(conv)
         except Exception as exc:
+            # reprises épuisées (cf. model.STREAM_MAX_RESUMES) : on garde le partiel
             logger.exception("stream error")
+            if buffer:
+                _append_message(conv, {"role": "assistant", "content": buffer, "incomplete": True})
+                await asyncio.to_thread(update_conversation, conv)
             yield f"\n[ERREUR] {exc}\n"
 
     return StreamingResponse(
@@ -406,6 +569,7 @@ def chat_stream(req: ChatRequest, user: dict = Depends(get_current_user)):
             "Cache-Control": "no-cache",
             "X-Accel-Buffering": "no",
             "x-conversation-id": conv["id"],
+            **_prompt_headers(report),
             **llm_headers,
         },
     )
@@ -425,43 +589,23 @@ async def upload_documents(
 ):
     uid = user["entra_oid"]
     logger.info("Upload docs (%d fichier·s) by %s", len(files), uid)
-    uploaded_docs = []
-
-    for file in files:
-        data = await file.read()
-        name = file.filename
-        ctype= file.content_type or mimetypes.guess_type(name)[0] or ""
-        low  = name.lower()
-
-        if ctype.startswith("image/"):
-            b64 = base64.b64encode(data).decode()
-            url = f"data:{ctype};base64,{b64}"
-            uploaded_docs.append({"name": name, "content": "", "summary": "",
-                                  "type": ctype, "url": url})
-            continue
-
-        if   low.endswith(".pdf"):  text = parse_pdf(data)
-        elif low.endswith(".docx"): text = parse_docx(data)
-        elif low.endswith(".txt"):  text = parse_txt(data)
-        elif low.endswith(".csv"):  text = parse_excel(data)
-        else:                       text = ""
-
-        summary = summarize_text(text)
-        uploaded_docs.append({"name": name, "content": text, "summary": summary})
+    # parse → résumé ‖ index, tous les fichiers en parallèle
+    uploaded_docs, results = await ingest_files(files, allow_images=True)
 
+    # Cosmos : hors boucle d’événements
     if conversationId:
-        conv = get_conversation(uid, conversationId)
+        conv = await asyncio.to_thread(get_conversation, uid, conversationId)
         if not conv: raise HTTPException(404, "Conversation non trouvée")
         conv["documents"] = conv.get("documents", []) + uploaded_docs
         conv.setdefault("type", "doc")
     else:
-        conv = create_conversation(uid, "", conversation_type="doc")
+        conv = await asyncio.to_thread(create_conversation, uid, "", conversation_type="doc")
         conv["documents"] = uploaded_docs
         conv["messages"]  = []
 
-    update_conversation(conv)
+    await asyncio.to_thread(update_conversation, conv)
     logger.debug("Docs ajoutés à conv %s", conv["id"])
-    return {"conversationId": conv["id"], "documents": uploaded_docs}
+    return {"conversationId": conv["id"], "documents": uploaded_docs, "results": results}
 
 # ─────────────────────────────────────────────────────────────── Projets
 @router.post("/projects", status_code=201)
@@ -501,26 +645,36 @@ async def upload_project_files(
     files: List[UploadFile] = File(...),
     user: dict = Depends(get_current_user),
 ):
-    proj = get_project(user["entra_oid"], project_id)
+    proj = await asyncio.to_thread(get_project, user["entra_oid"], project_id)
     if not proj: raise HTTPException(404, "Projet non trouvé")
 
     proj_files = proj.get("files", [])
-    for f in files:
-        data = await f.read()
-        name = f.filename
-        low  = name.lower()
-        if   low.endswith(".pdf"):  text = parse_pdf(data)
-        elif low.endswith(".docx"): text = parse_docx(data)
-        elif low.endswith(".txt"):  text = parse_txt(data)
-        elif low.endswith(".csv"):  text = parse_excel(data)
-        else:                       text = ""
-        summary = summarize_text(text)
-        proj_files.append({"name": name, "content": text, "summary": summary})
-
-    proj["files"] = proj_files
-    update_project(proj)
+    new_files, results = await ingest_files(files)
+
+    proj["files"] = proj_files + new_files
+    # chargement / indexation des nouveaux fichiers : hors boucle d’événements
+    await asyncio.to_thread(project_store, proj)
+    await asyncio.to_thread(update_project, proj)
     logger.debug("Ajout de %d fichiers au projet %s", len(files), project_id)
-    return {"projectId": project_id, "files": proj_files}
+    return {"projectId": project_id, "files": proj["files"], "results": results}
+
+@router.delete("/projects/{project_id}/files/{file_name}")
+def delete_project_file(
+    project_id: str,
+    file_name: str,
+    user: dict = Depends(get_current_user),
+):
+    proj = get_project(user["entra_oid"], project_id)
+    if not proj: raise HTTPException(404, "Projet non trouvé")
+
+    removed = [f for f in proj.get("files", []) if f["name"] == file_name]
+    if not removed: raise HTTPException(404, "Fichier non trouvé")
+
+    proj["files"] = [f for f in proj.get("files", []) if f["name"] != file_name]
+    project_store(proj)                   # snapshot sans le fichier retiré
+    update_project(proj)
+    logger.debug("Suppression de %s du projet %s", file_name, project_id)
+    return {"projectId": project_id, "files": proj["files"]}
 
 @router.post("/docs/create")
 async def create_document(req: Request, user: dict = Depends(get_current_user)):
@@ -566,5 +720,22 @@ async def create_document(req: Request, user: dict = Depends(get_current_user)):
 
 @router.get("/quota")
 def get_quota():
-    return {m: {"rpm": cfg["rpm"], "tpm": cfg["tpm"]}
-            for m, cfg in RAW_MODELS.items()}
\ No newline at end of file
+    # limites par famille + capacité restante et santé de chaque déploiement
+    return {m: {"rpm": cfg["rpm"], "tpm": cfg["tpm"], "deployments": deployment_status(m)}
+            for m, cfg in RAW_MODELS.items()}
+
+@router.get("/cache/stats")
+def get_cache_stats():
+    return cache_stats()
+
+@router.get("/hedge/stats")
+def get_hedge_stats():
+    return hedger.stats()
+
+@router.get("/singleflight/stats")
+def get_singleflight_stats():
+    return flight_stats()
+
+@router.get("/scheduler/stats")
+def get_scheduler_stats():
+    return scheduler.stats()
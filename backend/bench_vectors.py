@@ -0,0 +1,55 @@
+"""
+Benchmark – stockage int8 vs float32 (recall@4, mémoire, latence)
+─────────────────────────────────────────────────────────────────
+    python -m backend.bench_vectors [n] [dim]
+
+Vecteurs synthétiques regroupés en clusters (proche de la distribution
+d’ada-002 : beaucoup de voisins très similaires), requêtes bruitées.
+La vérité terrain = top-4 exact en float32.
+"""
+
+from __future__ import annotations
+
+import sys, time
+
+import numpy as np
+
+from backend import quant
+
+K, N_QUERIES = 4, 200
+
+def _data(n: int, dim: int, rng: np.random.Generator) -> tuple[np.ndarray, np.ndarray]:
+    centers = rng.standard_normal((max(1, n // 50), dim)).astype(np.float32)
+    vecs    = centers[rng.integers(0, len(centers), n)] + 0.35 * rng.standard_normal((n, dim)).astype(np.float32)
+    vecs   /= np.linalg.norm(vecs, axis=1, keepdims=True)
+    qs      = vecs[rng.integers(0, n, N_QUERIES)] + 0.2 * rng.standard_normal((N_QUERIES, dim)).astype(np.float32)
+    qs     /= np.linalg.norm(qs, axis=1, keepdims=True)
+    return vecs, qs
+
+def _recall(found: list[np.ndarray], truth: list[np.ndarray]) -> float:
+    return float(np.mean([len(set(f) & set(t)) / K for f, t in zip(found, truth)]))
+
+def main(n: int = 50_000, dim: int = 1_536) -> None:
+    rng = np.random.default_rng(0)
+    vecs, qs = _data(n, dim, rng)
+    codes, scales = quant.quantize(vecs)
+
+    t0 = time.perf_counter()
+    truth = [np.argsort(-(vecs @ q))[:K] for q in qs]
+    t_exact = (time.perf_counter() - t0) / N_QUERIES
+
+    rows = [("float32 exact", vecs.nbytes, 1.0, t_exact)]
+    for rerank in (1, 4, 8):
+        t0 = time.perf_counter()
+        found = [quant.search(vecs, codes, scales, q, K, rerank=rerank)[0] for q in qs]
+        dt = (time.perf_counter() - t0) / N_QUERIES
+        rows.append((f"int8 + re-rank ×{rerank}", codes.nbytes + scales.nbytes,
+                     _recall(found, truth), dt))
+
+    print(f"n={n}  dim={dim}  requêtes={N_QUERIES}")
+    print(f"{'méthode':<22}{'mémoire balayée':>18}{'recall@4':>10}{'ms/requête':>12}")
+    for name, size, rec, dt in rows:
+        print(f"{name:<22}{size / 2**20:>15.1f} Mo{rec:>10.3f}{dt * 1e3:>12.2f}")
+
+if __name__ == "__main__":
+    main(*(int(a) for a in sys.argv[1:3]))
@@ -0,0 +1,164 @@
+"""
+Caches – LRU + TTL, bornés, thread-safe, avec compteurs
+───────────────────────────────────────────────────────
+• TTLCache  : en mémoire (embeddings de requêtes, résultats de recherche)
+• DiskCache : SQLite local, borné en octets, partagé entre workers
+              (textes parsés + résumés des documents, cf. ingest.py)
+
+Chaque cache nommé est enregistré dans CACHES :
+`cache_stats()` renvoie hits / misses / taille de tous les caches.
+"""
+
+from __future__ import annotations
+
+import os, json, time, sqlite3, tempfile, threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict, Hashable, Optional
+
+CACHE_DIR = Path(os.getenv("CACHE_DIR", Path(tempfile.gettempdir()) / "klint_cache"))
+
+_MISSING = object()
+
+class TTLCache:
+    def __init__(self, name: str, maxsize: int = 1_024, ttl: float = 600.0):
+        self.name, self.maxsize, self.ttl = name, maxsize, ttl
+        self._data: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+        CACHES[name] = self
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:                       # expiré
+                    del self._data[key]
+                    self.evictions += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_set(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = fn()
+            self.set(key, value)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data), "maxsize": self.maxsize, "ttl": self.ttl,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "hit_rate": round(self.hits / total, 3) if total else None,
+            }
+
+class DiskCache:
+    """
+    Cache clé → JSON sur disque (SQLite, WAL).  Éviction LRU dès que la
+    taille totale dépasse `max_bytes` ; TTL optionnel.
+    Taille totale tenue à jour en mémoire (pas de SUM à chaque écriture) ;
+    recalée sur la base au moment d’évincer (les autres workers écrivent aussi).
+    """
+
+    def __init__(self, name: str, max_bytes: int, ttl: float | None = None,
+                 path: Path | None = None):
+        self.name, self.max_bytes, self.ttl = name, max_bytes, ttl
+        self.path = path or CACHE_DIR / f"{name}.sqlite"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL,"
+            " expires REAL, last_access REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS cache_lru ON cache(last_access)")
+        self._bytes = self._total()
+        self.hits = self.misses = self.evictions = 0
+        CACHES[name] = self
+
+    def get(self, key: str, default: Any = None) -> Any:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value, expires, size FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None or (row[1] is not None and row[1] < now):
+                if row is not None:
+                    self._db.execute("DELETE FROM cache WHERE key = ?", (key,))
+                    self._bytes -= row[2]
+                    self.evictions += 1
+                self.misses += 1
+                return default
+            self._db.execute("UPDATE cache SET last_access = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any) -> None:
+        data = json.dumps(value, ensure_ascii=False)
+        size = len(data.encode())
+        now  = time.time()
+        with self._lock:
+            old = self._db.execute("SELECT size FROM cache WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)",
+                (key, data, size, now + self.ttl if self.ttl else None, now),
+            )
+            self._bytes += size - (old[0] if old else 0)
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    def _total(self) -> int:
+        return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+
+    def _evict(self) -> None:
+        self._bytes = self._total()                  # recalage (écritures des autres workers)
+        while self._bytes > self.max_bytes:
+            row = self._db.execute(
+                "SELECT key, size FROM cache ORDER BY last_access LIMIT 1").fetchone()
+            if row is None:
+                break
+            self._db.execute("DELETE FROM cache WHERE key = ?", (row[0],))
+            self._bytes -= row[1]
+            self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM cache")
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            n, size = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
+        total = self.hits + self.misses
+        return {
+            "size": n, "bytes": size, "max_bytes": self.max_bytes, "ttl": self.ttl,
+            "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 3) if total else None,
+        }
+
+CACHES: Dict[str, Any] = {}
+
+def cache_stats(name: Optional[str] = None) -> Dict[str, Any]:
+    if name:
+        return CACHES[name].stats()
+    return {n: c.stats() for n, c in CACHES.items()}
@@ -1,5 +1,7 @@
 import os
 from azure.cosmos import CosmosClient
+from azure.cosmos.exceptions import CosmosAccessConditionFailedError
+from azure.core import MatchConditions
 from datetime import datetime
 import uuid
 from dotenv import load_dotenv
@@ -52,8 +54,52 @@ def get_conversation(entra_oid: str, conversation_id: str) -> dict:
 
 
 def update_conversation(conversation_data: dict) -> None:
-    conversation_data["updated_at"] = datetime.utcnow().isoformat()
-    container.upsert_item(conversation_data)
+    """
+    Écriture conditionnelle (_etag) : si le document a changé entre-temps
+    (résumé écrit en tâche de fond), on reprend le résumé le plus récent
+    puis on réécrit – le reste reste « dernier écrivain gagne ».
+    """
+    conv = conversation_data
+    while True:
+        conv["updated_at"] = datetime.utcnow().isoformat()
+        if not conv.get("_etag"):
+            conv["_etag"] = container.upsert_item(conv)["_etag"]
+            return
+        try:
+            conv["_etag"] = container.replace_item(
+                conv["id"], conv, etag=conv["_etag"],
+                match_condition=MatchConditions.IfNotModified,
+            )["_etag"]
+            return
+        except CosmosAccessConditionFailedError:
+            fresh = get_conversation(conv["entra_oid"], conv["id"])
+            if fresh is None:
+                conv.pop("_etag", None)
+                continue
+            if fresh.get("summary_index", 0) > conv.get("summary_index", 0):
+                conv["summary"]       = fresh.get("summary", "")
+                conv["summary_index"] = fresh["summary_index"]
+            conv["_etag"] = fresh["_etag"]
+
+def commit_summary(entra_oid: str, conversation_id: str, expected_index: int,
+                   summary: str, summary_index: int) -> bool:
+    """
+    Enregistre un résumé calculé hors requête, seulement si `summary_index`
+    vaut toujours `expected_index` (concurrence optimiste) ; False sinon.
+    """
+    for _ in range(5):
+        item = get_conversation(entra_oid, conversation_id)
+        if item is None or item.get("summary_index", 0) != expected_index:
+            return False
+        item["summary"]       = summary
+        item["summary_index"] = summary_index
+        try:
+            container.replace_item(item["id"], item, etag=item["_etag"],
+                                   match_condition=MatchConditions.IfNotModified)
+            return True
+        except CosmosAccessConditionFailedError:
+            continue                        # message ajouté entre-temps : on relit
+    return False
 
 def list_conversations(entra_oid: str, conversation_type=None, project_id=None) -> list:
     query = (
@@ -0,0 +1,139 @@
+"""
+Client d’embeddings Azure OpenAI – lots dimensionnés en tokens, envois
+concurrents, quotas RPM/TPM par endpoint, bascule multi-déploiements.
+
+• les morceaux sont tokenisés (tiktoken, cl100k_base = encodage d’ada-002)
+  puis regroupés en lots ≤ EMBED_BATCH_TOKENS / EMBED_MAX_INPUTS
+• EMBED_CONCURRENCY lots partent en parallèle (threads)
+• chaque envoi réserve ses jetons dans le limiteur RPM/TPM de son
+  déploiement (rate_limit.py), ajusté sur l’`usage` renvoyé
+• chaque envoi choisit son déploiement via le routeur (charge, latence,
+  erreurs) ; 429/503 → le déploiement refroidit, l’envoi repart ailleurs
+  (même mécanique que azure_llm_chat : _pickup_creds / _observe_failure)
+"""
+
+from __future__ import annotations
+
+import os, time, logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+import requests
+
+from backend.model import (
+    EMBED_MODELS, _ENC, _pickup_creds, _observe_failure,
+    MAX_LOCAL_RETRY, http_session, deployment_limiter,
+)
+from backend.router import router
+from backend.scheduler import bind
+
+logger = logging.getLogger(__name__)
+
+EMBED_FAMILY       = "ada-002"
+EMBED_BATCH_TOKENS = int(os.getenv("EMBED_BATCH_TOKENS", "16000"))
+EMBED_MAX_INPUTS   = int(os.getenv("EMBED_MAX_INPUTS", "2048"))
+EMBED_CONCURRENCY  = int(os.getenv("EMBED_CONCURRENCY", "4"))
+
+def _url(endpoint: str) -> str:
+    """Accepte une URL complète …/embeddings?… ou la racine de la ressource."""
+    if "/embeddings" in endpoint:
+        return endpoint
+    cfg = EMBED_MODELS[EMBED_FAMILY]
+    return (f"{endpoint.rstrip('/')}/openai/deployments/{cfg['deployment']}"
+            f"/embeddings?api-version={cfg['api_version']}")
+
+# ──────────────────────────── découpage en lots
+def _prepare(texts: List[str]) -> Tuple[List[str], List[int]]:
+    """Tronque à max_input_tokens ; retourne (textes, nb tokens) en 1 passe."""
+    limit = EMBED_MODELS[EMBED_FAMILY]["max_input_tokens"]
+    out, counts = [], []
+    for t, toks in zip(texts, _ENC.encode_batch(texts, disallowed_special=())):
+        if len(toks) > limit:
+            t, toks = _ENC.decode(toks[:limit]), toks[:limit]
+        out.append(t or " ")
+        counts.append(max(1, len(toks)))
+    return out, counts
+
+def _batches(counts: List[int]) -> List[List[int]]:
+    """Regroupe les indices en lots bornés en tokens et en nombre d’entrées."""
+    batches: List[List[int]] = []
+    cur: List[int] = []
+    cur_tok = 0
+    for i, n in enumerate(counts):
+        if cur and (cur_tok + n > EMBED_BATCH_TOKENS or len(cur) >= EMBED_MAX_INPUTS):
+            batches.append(cur)
+            cur, cur_tok = [], 0
+        cur.append(i)
+        cur_tok += n
+    if cur:
+        batches.append(cur)
+    return batches
+
+# ──────────────────────────── client
+class EmbeddingClient:
+    def __init__(self, family: str = EMBED_FAMILY, concurrency: int = EMBED_CONCURRENCY):
+        self.family = family
+        self.pool   = ThreadPoolExecutor(max_workers=max(1, concurrency),
+                                         thread_name_prefix="embed")
+
+    def _post(self, batch: List[str], tokens: int) -> List[List[float]]:
+        cfg = EMBED_MODELS[self.family]
+
+        for attempt in range(len(cfg["env_keys"]) * MAX_LOCAL_RETRY):
+            api_key, ep, wait = _pickup_creds(self.family)
+            if wait:
+                time.sleep(wait)
+            lim = deployment_limiter(self.family, ep)
+            lim.acquire(tokens)
+            used, r = 0, None
+            router.begin(ep)
+            t0 = time.monotonic()
+            try:
+                r = http_session().post(
+                    _url(ep),
+                    headers={"api-key": api_key, "Content-Type": "application/json"},
+                    json={"input": batch}, timeout=60,
+                )
+                r.raise_for_status()
+                body = r.json()
+                used = body.get("usage", {}).get("total_tokens", tokens)
+                router.observe(ep, time.monotonic() - t0, True)
+                data = sorted(body["data"], key=lambda d: d["index"])
+                return [d["embedding"] for d in data]
+            except requests.HTTPError as exc:
+                _observe_failure(ep, t0, r, attempt)
+                if r.status_code not in (429, 503):
+                    raise RuntimeError(f"Azure embeddings {r.status_code}: {exc}") from exc
+            except requests.RequestException:
+                _observe_failure(ep, t0, None, attempt)
+            finally:
+                router.release(ep)
+                lim.reconcile(tokens, used)
+
+        raise RuntimeError(f"Toutes les tentatives d’embedding ont échoué ({self.family})")
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        """Vectorise `texts` (ordre conservé) en lots concurrents."""
+        if not texts:
+            return []
+        texts, counts = _prepare(texts)
+        batches = _batches(counts)
+        t0      = time.time()
+        results = self.pool.map(
+            bind(lambda b: self._post([texts[i] for i in b], sum(counts[i] for i in b))),
+            batches,
+        )
+
+        out: List[List[float]] = [None] * len(texts)        # type: ignore[list-item]
+        for idxs, vecs in zip(batches, results):
+            for i, v in zip(idxs, vecs):
+                out[i] = v
+        logger.info("Embeddings : %d textes / %d lots en %.2fs",
+                    len(texts), len(batches), time.time() - t0)
+        return out
+
+    def embed_query(self, text: str) -> List[float]:
+        texts, counts = _prepare([text])
+        return self._post(texts, counts[0])[0]
+
+client = EmbeddingClient()
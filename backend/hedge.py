@@ -0,0 +1,79 @@
+"""
+Requêtes « couvertes » (hedging) – réduction de la latence de queue
+───────────────────────────────────────────────────────────────────
+Sur option (`azure_llm_chat(..., hedge=True)`) : si aucune réponse
+n’est arrivée après le HEDGE_PERCENTILE des latences récentes du modèle,
+un doublon part vers un AUTRE déploiement de la famille ; la première
+réponse gagne, l’autre est abandonnée (annulée en async ; en sync elle
+finit sa requête en cours sans nouvelle tentative).
+
+• délai par famille = percentile des HEDGE_WINDOW dernières latences
+  (HEDGE_DEFAULT_S tant qu’il y a moins de HEDGE_MIN_SAMPLES mesures)
+• budget : chaque appel crédite HEDGE_BUDGET doublon (≤ HEDGE_BURST
+  en réserve) ; un doublon coûte 1 → ~10 % de trafic en plus au maximum
+• métriques : appels, doublons, victoires du doublon, refus budget
+"""
+
+from __future__ import annotations
+
+import os, threading
+from collections import defaultdict, deque
+from typing import Deque, Dict
+
+HEDGE_ENABLED     = os.getenv("HEDGE_ENABLED", "1") == "1"
+HEDGE_PERCENTILE  = float(os.getenv("HEDGE_PERCENTILE", "0.95"))
+HEDGE_WINDOW      = int(os.getenv("HEDGE_WINDOW", "200"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_DEFAULT_S   = float(os.getenv("HEDGE_DEFAULT_S", "10"))
+HEDGE_BUDGET      = float(os.getenv("HEDGE_BUDGET", "0.1"))
+HEDGE_BURST       = float(os.getenv("HEDGE_BURST", "5"))
+
+class Hedger:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._lat: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=HEDGE_WINDOW))
+        self._credit = HEDGE_BURST
+        self.calls = self.hedged = self.wins = self.denied = 0
+
+    def record(self, model: str, latency: float) -> None:
+        with self._lock:
+            self._lat[model].append(latency)
+
+    def delay(self, model: str) -> float:
+        """Attente avant d’envoyer le doublon (compte aussi l’appel dans le budget)."""
+        with self._lock:
+            self.calls  += 1
+            self._credit = min(HEDGE_BURST, self._credit + HEDGE_BUDGET)
+            return self._pct(model)
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._credit < 1:
+                self.denied += 1
+                return False
+            self._credit -= 1
+            self.hedged  += 1
+            return True
+
+    def won(self) -> None:
+        with self._lock:
+            self.wins += 1
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            return {
+                "enabled": HEDGE_ENABLED,
+                "calls": self.calls, "hedged": self.hedged,
+                "hedge_wins": self.wins, "budget_denied": self.denied,
+                "hedge_rate": round(self.hedged / self.calls, 3) if self.calls else None,
+                "win_rate": round(self.wins / self.hedged, 3) if self.hedged else None,
+                "delay_s": {m: round(self._pct(m), 2) for m in self._lat},
+            }
+
+    def _pct(self, model: str) -> float:
+        lat = sorted(self._lat[model])
+        if len(lat) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_S
+        return lat[min(len(lat) - 1, int(HEDGE_PERCENTILE * len(lat)))]
+
+hedger = Hedger()
@@ -0,0 +1,122 @@
+"""
+Pipeline d’ingestion des uploads : parse → (résumé ‖ index) par fichier,
+tous les fichiers de la requête en parallèle.
+
+• UPLOAD_CONCURRENCY fichiers traités simultanément (borné aussi par le
+  RPM du modèle de résumé : le quota reste géré par azure_llm_chat)
+• parsing dans le pool de process (parsing.py), résumé + indexation en
+  threads, lancés en même temps une fois le texte extrait
+• un fichier en erreur n’interrompt pas les autres : status « error »
+• chaque résultat porte ses temps (read / parse / summary / index)
+• CSV / Excel : stockés en Parquet (tables.py) ; le texte du document
+  devient le schéma + aperçu, les questions chiffrées passent par pandas
+• appels LLM / embeddings en classe « background » (scheduler.py)
+• dédoublonnage : clé = sha256(octets) + version parseur + version résumé
+  → un fichier déjà vu (autre conversation / projet) est servi depuis le
+  cache disque (texte, résumé, ids des morceaux), sans parsing ni LLM
+"""
+
+from __future__ import annotations
+
+import os, time, base64, asyncio, hashlib, logging, mimetypes
+from typing import List, Tuple
+
+from fastapi import UploadFile
+
+from backend.model import RAW_MODELS
+from backend.cache import DiskCache
+from backend.models import (
+    parse_document, summarize_text,
+    SUMMARY_MODEL, SUMMARY_VERSION, PARSER_VERSION,
+)
+from backend.parsing import run_in_pool
+from backend.scheduler import priority
+from backend.tables import is_table, store_table
+from backend.vectorstore import ingest_document, INDEX_VERSION
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_CONCURRENCY = min(
+    int(os.getenv("UPLOAD_CONCURRENCY", "4")),
+    int(RAW_MODELS[SUMMARY_MODEL]["rpm"]),
+)
+
+_DOCS = DiskCache("documents", max_bytes=int(os.getenv("DOC_CACHE_MAX_MB", "512")) * 2**20)
+
+def _doc_key(name: str, data: bytes) -> str:
+    h = hashlib.sha256(data)
+    ext = os.path.splitext(name.lower())[1]          # le parseur dépend de l’extension
+    h.update(f"|{ext}|{PARSER_VERSION}|{SUMMARY_VERSION}|{INDEX_VERSION}".encode())
+    return h.hexdigest()
+
+async def _timed(timings: dict, step: str, coro):
+    t0 = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        timings[step] = round(time.perf_counter() - t0, 3)
+
+async def _ingest_one(file: UploadFile, allow_images: bool) -> Tuple[dict, dict]:
+    name    = file.filename
+    timings: dict = {}
+    t0      = time.perf_counter()
+    try:
+        data  = await _timed(timings, "read", file.read())
+        ctype = file.content_type or mimetypes.guess_type(name)[0] or ""
+
+        if allow_images and ctype.startswith("image/"):
+            url = f"data:{ctype};base64,{base64.b64encode(data).decode()}"
+            doc = {"name": name, "content": "", "summary": "", "type": ctype, "url": url}
+        else:
+            key    = _doc_key(name, data)
+            cached = await asyncio.to_thread(_DOCS.get, key)
+            if cached:
+                timings["cache"] = "hit"
+                doc = {"name": name, **cached}
+            else:
+                table = None
+                if is_table(name):
+                    stored = await _timed(timings, "parse", run_in_pool(store_table, name, data))
+                    text, table = stored["text"], stored["table"]
+                else:
+                    text = await _timed(timings, "parse", parse_document(name, data))
+                summary, meta = await asyncio.gather(
+                    _timed(timings, "summary", asyncio.to_thread(summarize_text, text)),
+                    _timed(timings, "index",   asyncio.to_thread(ingest_document, text)),
+                )
+                doc = {"name": name, "content": text, "summary": summary, **meta}
+                if table:
+                    doc["table"] = table
+                if meta.get("status") in ("ready", "empty"):       # pas de « pending »
+                    await asyncio.to_thread(_DOCS.set, key, {k: v for k, v in doc.items() if k != "name"})
+        status, error = doc.get("status", "ready"), None
+    except Exception as exc:
+        logger.exception("Ingestion de %s impossible", name)
+        doc, status, error = None, "error", str(exc)
+
+    timings["total"] = round(time.perf_counter() - t0, 3)
+    result = {"name": name, "status": status, "timings": timings}
+    if error:
+        result["error"] = error
+    return doc, result
+
+async def ingest_files(files: List[UploadFile],
+                       allow_images: bool = False) -> Tuple[List[dict], List[dict]]:
+    """
+    Ingère tous les fichiers en parallèle (borné).  Retourne
+    (documents à persister, résultats par fichier avec temps).
+    """
+    sem = asyncio.Semaphore(max(1, UPLOAD_CONCURRENCY))
+
+    async def _bounded(f: UploadFile):
+        async with sem:
+            return await _ingest_one(f, allow_images)
+
+    t0 = time.perf_counter()
+    with priority("background"):        # résumés / embeddings : derrière le chat en direct
+        pairs = await asyncio.gather(*(_bounded(f) for f in files))
+    logger.info("Ingestion de %d fichier·s en %.2fs", len(files), time.perf_counter() - t0)
+
+    docs    = [d for d, _ in pairs if d is not None]
+    results = [r for _, r in pairs]
+    return docs, results
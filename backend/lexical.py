@@ -0,0 +1,113 @@
+"""
+Index lexical local (BM25) – complément de la recherche vectorielle
+───────────────────────────────────────────────────────────────────
+• un index inversé par document, construit sur les MÊMES morceaux
+  que les vecteurs, stocké à côté (lexical.json)
+• la recherche agrège les statistiques (N, df, longueur moyenne) de
+  tous les documents interrogés → score BM25 cohérent multi-docs
+• les numéros de facture, codes produit, noms… sont gardés tels quels
+"""
+
+from __future__ import annotations
+
+import re, math, unicodedata
+from collections import Counter
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+K1, B = 1.2, 0.75
+
+_TOKEN = re.compile(r"[a-z0-9]+(?:[-_./][a-z0-9]+)*")
+
+_STOP = frozenset("""
+a au aux avec ce ces cette dans de des du elle en est et il ils je la le les leur
+leurs mais me mes mon ne nous on ou par pas pour qu que qui sa se ses son sont sur
+ta te tes ton tu un une vos votre vous y l d j s c n m t quel quelle quels quelles
+comment combien quoi the an and are as at be by for from has have in is it
+its of on or that this to was were what which who with how
+""".split())
+
+def _fold(text: str) -> str:
+    """minuscules + suppression des accents (é → e)."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in _TOKEN.findall(_fold(text)) if t not in _STOP]
+
+# ──────────────────────────── index d’un document
+@dataclass(frozen=True)
+class LexicalIndex:
+    postings: Dict[str, List[Tuple[int, int]]]     # terme → [(morceau, tf)]
+    lengths:  List[int]                            # nb de termes par morceau
+
+    @classmethod
+    def build(cls, chunks: Sequence[str]) -> "LexicalIndex":
+        postings: Dict[str, List[Tuple[int, int]]] = {}
+        lengths: List[int] = []
+        for i, chunk in enumerate(chunks):
+            toks = tokenize(chunk)
+            lengths.append(len(toks))
+            for term, tf in Counter(toks).items():
+                postings.setdefault(term, []).append((i, tf))
+        return cls(postings, lengths)
+
+    def to_json(self) -> dict:
+        return {"postings": self.postings, "lengths": self.lengths}
+
+    @classmethod
+    def from_json(cls, data: dict) -> "LexicalIndex":
+        return cls({t: [tuple(p) for p in ps] for t, ps in data["postings"].items()},
+                   data["lengths"])
+
+# ──────────────────────────── BM25 multi-documents
+def bm25_search(indexes: Sequence[LexicalIndex], query: str,
+                k: int = 20) -> List[Tuple[float, int, int]]:
+    """
+    Retourne [(score, n° index, n° morceau)] triés par score décroissant.
+    """
+    terms = set(tokenize(query))
+    if not terms or not indexes:
+        return []
+
+    n_docs = sum(len(ix.lengths) for ix in indexes)
+    avgdl  = max(1e-9, sum(sum(ix.lengths) for ix in indexes) / max(1, n_docs))
+    df     = {t: sum(len(ix.postings.get(t, ())) for ix in indexes) for t in terms}
+
+    scores: Dict[Tuple[int, int], float] = {}
+    for t in terms:
+        if not df[t]:
+            continue
+        idf = math.log(1 + (n_docs - df[t] + 0.5) / (df[t] + 0.5))
+        for d, ix in enumerate(indexes):
+            for chunk, tf in ix.postings.get(t, ()):
+                norm = K1 * (1 - B + B * ix.lengths[chunk] / avgdl)
+                scores[(d, chunk)] = scores.get((d, chunk), 0.0) + idf * tf * (K1 + 1) / (tf + norm)
+
+    best = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)[:k]
+    return [(s, d, c) for (d, c), s in best]
+
+_CODE = re.compile(r"[0-9_-]")
+
+def is_keyword_query(query: str, max_terms: int = 3) -> bool:
+    """
+    Requête « mots-clés » (ex. « facture F-2024-118 ») : au plus `max_terms`
+    mots BRUTS, et soit aucun mot vide / interrogatif, soit un code (chiffre,
+    « - », « _ ») → la voie lexicale suffit, pas d’embedding.
+    Toute phrase (« quel est le montant de la facture ») passe par l’hybride.
+    """
+    if "?" in query:
+        return False
+    words = _TOKEN.findall(_fold(query))
+    if not 0 < len(words) <= max_terms:
+        return False
+    return not any(w in _STOP for w in words) or any(_CODE.search(w) for w in words)
+
+# ──────────────────────────── fusion
+def rrf_fuse(rankings: Iterable[Sequence[Tuple[int, int]]], k: int = 60) -> List[Tuple[int, int]]:
+    """Reciprocal Rank Fusion : Σ 1 / (k + rang)."""
+    scores: Dict[Tuple[int, int], float] = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=scores.__getitem__, reverse=True)
@@ -14,7 +14,7 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
 
 from backend.api import router
-from backend.model import azure_llm_chat
+from backend.model import azure_llm_chat, aclose_clients
 
 
 ###############################################################################
@@ -40,6 +40,10 @@ app.add_middleware(
 ###############################################################################
 app.include_router(router, prefix="/api", tags=["api"])
 
+@app.on_event("shutdown")
+async def _close_http_pools():
+    await aclose_clients()
+
 @app.get("/ping")
 def ping():
     """Endpoint de santé (Azure Health Check)."""
@@ -49,7 +53,7 @@ def ping():
 def sample_llm_call():
     question = "Test"
     messages = [{"role": "user", "content": question}]
-    answer = azure_llm_chat(messages)
+    answer = azure_llm_chat(messages, cache="exact")
     return {"question": question, "answer": answer}
 
 ###############################################################################
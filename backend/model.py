@@ -1,15 +1,33 @@
 """
-Wrapper Azure OpenAI – multi-déploiements, rotation « on fail », quota local RPM,
-streaming + sync.
+Wrapper Azure OpenAI – multi-déploiements routés selon charge / latence /
+erreurs (router.py), quota local RPM + TPM par déploiement (rate_limit.py),
+streaming + sync + async, cache de réponses sur option (`cache=`).
+
+Connexions HTTP réutilisées (keep-alive) : une `requests.Session` partagée
+pour les appels sync, un `httpx.AsyncClient` par endpoint pour les *_async
+(HTTP/2 si le paquet h2 est installé).
 """
 
 from __future__ import annotations
 
-import os, time, random, json, threading, base64, logging, tiktoken
-from collections import defaultdict, deque
-from typing import Dict, Deque, Iterable, List, Tuple, Generator   # ← +Generator
+import os, time, random, json, queue, asyncio, hashlib, threading, base64, logging, tiktoken
+import concurrent.futures as cf
+import importlib.util
+from collections import deque
+from typing import Dict, Deque, Iterable, List, Optional, Tuple, Generator, AsyncGenerator
+from urllib.parse import urlsplit
 from fastapi import HTTPException 
 import requests
+import httpx
+import numpy as np
+from requests.adapters import HTTPAdapter
+
+from backend.rate_limit import Limiter, limiter, get_limiter
+from backend.router import router
+from backend.hedge import hedger, HEDGE_ENABLED
+from backend.cache import DiskCache, CACHES
+from backend.singleflight import SingleFlight
+from backend.scheduler import bind, current_priority
 from dotenv import load_dotenv
 
 # ───────────────────────────────  .env
@@ -22,6 +40,7 @@ _ENC = tiktoken.get_encoding("cl100k_base")
 
 # ╔══════════════════════════════  REGISTRY  ══════════════════════════════╗
 #  Pour chaque famille : liste (api_key_env, endpoint_env) + quotas.
+#  max_tokens = sortie max ; context_window = entrée + sortie (cf. prompt_budget)
 # ╚═══════════════════════════════════════════════════════════════════════╝
 RAW_MODELS: Dict[str, Dict[str, object]] = {
     # ─────────── GPT-4o ───────────
@@ -32,6 +51,7 @@ RAW_MODELS: Dict[str, Dict[str, object]] = {
             ("AZ_OPENAI_API_4o", "AZ_OPENAI_ENDPOINT_4o_3"),
         ],
         "max_tokens": 4_096,
+        "context_window": 128_000,
         "rpm": 48,
         "tpm": 8_000,
         "payload_key": "max_tokens",
@@ -43,6 +63,7 @@ RAW_MODELS: Dict[str, Dict[str, object]] = {
             ("AZ_OPENAI_API_4o_mini_ada_002", "AZ_OPENAI_ENDPOINT_4o_mini_3"),
         ],
         "max_tokens": 4_096,
+        "context_window": 128_000,
         "rpm": 2_500,
         "tpm": 250_000,
         "payload_key": "max_tokens",
@@ -55,6 +76,7 @@ RAW_MODELS: Dict[str, Dict[str, object]] = {
             ("AZ_OPENAI_API_o1", "AZ_OPENAI_ENDPOINT_o1_3"),
         ],
         "max_tokens": 40_000,
+        "context_window": 200_000,
         "rpm": 100,
         "tpm": 600_000,
         "payload_key": "max_completion_tokens",
@@ -67,6 +89,7 @@ RAW_MODELS: Dict[str, Dict[str, object]] = {
             ("AZ_OPENAI_API_o1_mini", "AZ_OPENAI_ENDPOINT_o1_mini_3"),
         ],
         "max_tokens": 40_000,
+        "context_window": 128_000,
         "rpm": 100,
         "tpm": 1_000_000,
         "payload_key": "max_completion_tokens",
@@ -80,6 +103,7 @@ RAW_MODELS: Dict[str, Dict[str, object]] = {
             ("AZ_OPENAI_API_o3_mini", "AZ_OPENAI_ENDPOINT_o3_mini_3"),
         ],
         "max_tokens": 100_000,
+        "context_window": 200_000,
         "rpm": 150,
         "tpm": 90_000,
         "payload_key": "max_completion_tokens",
@@ -92,6 +116,7 @@ RAW_MODELS: Dict[str, Dict[str, object]] = {
             ("AZ_OPENAI_API_o4_mini", "AZ_OPENAI_ENDPOINT_o4_mini_3"),
         ],
         "max_tokens": 100_000,
+        "context_window": 200_000,
         "rpm": 130,
         "tpm": 130_000,
         "payload_key": "max_completion_tokens",
@@ -104,6 +129,7 @@ RAW_MODELS: Dict[str, Dict[str, object]] = {
             ("AZ_OPENAI_API_4_1_mini", "AZ_OPENAI_ENDPOINT_4_1_mini_3"),
         ],
         "max_tokens": 8_192,
+        "context_window": 1_047_576,
         "rpm": 150,
         "tpm": 150_000,
         "payload_key": "max_completion_tokens",
@@ -115,63 +141,170 @@ RAW_MODELS: Dict[str, Dict[str, object]] = {
             ("AZ_OPENAI_API_4_1", "AZ_OPENAI_ENDPOINT_4_1_3"),
         ],
         "max_tokens": 8_192,
+        "context_window": 1_047_576,
         "rpm": 150,
         "tpm": 150_000,
         "payload_key": "max_completion_tokens",
     },
 }
 
+# ─────────── Embeddings (hors chat : pas exposés dans /quota) ───────────
+EMBED_MODELS: Dict[str, Dict[str, object]] = {
+    "ada-002": {
+        "env_keys": [
+            ("AZ_OPENAI_API_4o_mini_ada_002", "AZURE_OPENAI_EMBEDDINGS_ENDPOINT"),
+            ("AZ_OPENAI_API_4o_mini_ada_002", "AZURE_OPENAI_EMBEDDINGS_ENDPOINT_2"),
+            ("AZ_OPENAI_API_4o_mini_ada_002", "AZURE_OPENAI_EMBEDDINGS_ENDPOINT_3"),
+        ],
+        "deployment": "text-embedding-ada-002",
+        "api_version": "2023-05-15",
+        "max_input_tokens": 8_191,
+        "rpm": 720,
+        "tpm": 120_000,
+    },
+}
+
 # -------------------------------------------------------------
 #  utilitaire : compte les tokens d’une liste messages OpenAI
 # -------------------------------------------------------------
+TOKEN_ENCODER = _ENC.name          # clé des comptes mis en cache dans les messages
+
+# jetons de structure (rôle, séparateurs) : par message + amorce de réponse
+MESSAGE_OVERHEAD = 4
+REPLY_OVERHEAD   = 3
+
+def _text_of(content) -> str:
+    if isinstance(content, list):                     # vision : on ne garde que le texte
+        return "\n".join(p["text"] for p in content if p.get("type") == "text")
+    return str(content)
+
+def message_tokens(msg: dict) -> int:
+    """
+    Jetons du texte de `msg`, calculés une seule fois :
+    msg["tokens"] = {encodeur: n} (persisté avec la conversation).
+    """
+    counts = msg.get("tokens")
+    if not isinstance(counts, dict):
+        counts = msg["tokens"] = {}
+    n = counts.get(TOKEN_ENCODER)
+    if n is None:
+        n = counts[TOKEN_ENCODER] = len(_ENC.encode(_text_of(msg.get("content", "")),
+                                                    disallowed_special=()))
+    return n
+
 def _count_prompt_tokens(msgs: list[dict]) -> int:
     """
-    Version « rapide » : on concatène tous les textes.
-    Suffisant pour estimer la taille du prompt (< 1 ms).
+    Somme des messages (+ MESSAGE_OVERHEAD chacun) ; un compte déjà en cache
+    (message_tokens) est réutilisé. Les messages ne sont pas modifiés.
     """
-    parts: list[str] = []
+    total = MESSAGE_OVERHEAD * len(msgs)
     for m in msgs:
-        c = m.get("content", "")
-        if isinstance(c, list):                       # vision : on ne garde que le texte
-            parts.extend(p["text"] for p in c if p.get("type") == "text")
-        else:
-            parts.append(str(c))
-    return len(_ENC.encode("\n".join(parts)))
-
-# ╔════════════════════════════  RATE LIMIT (in-proc, par endpoint) ═════════╗
-_lock_rl = threading.Lock()
-_last_calls: Dict[str, Deque[float]] = defaultdict(deque)  # endpoint → ts <60 s
-
-def _wait_slot(endpoint: str, rpm: int) -> None:
-    """Bloque tant qu’aucun « crédit » RPM libre pour cet endpoint."""
-    with _lock_rl:
-        now = time.time()
-        q = _last_calls[endpoint]
-        while q and now - q[0] > 60:
-            q.popleft()
-        if len(q) < rpm:
-            q.append(now)
-            return
-        delay = 60 - (now - q[0]) + 0.05
-    time.sleep(delay)
-
-# ╔════════════════════════════  ROUND-ROBIN  « on fail »  ══════════════════╗
-_lock_ptr = threading.Lock()
-_ptr: Dict[str, int] = defaultdict(int)      # famille → index actuel
-
-def _pickup_creds(fam: str) -> Tuple[str, str, int]:
-    idx = _ptr[fam]
-    api_env, end_env = RAW_MODELS[fam]["env_keys"][idx]
-    api_key  = os.getenv(api_env)
-    endpoint = os.getenv(end_env)
-    if not api_key or not endpoint:
-        raise RuntimeError(f"Env manquant : {api_env}/{end_env}")
-    rpm = RAW_MODELS[fam]["rpm"]
-    return api_key, endpoint, rpm
+        n = (m.get("tokens") or {}).get(TOKEN_ENCODER)
+        total += n if n is not None else len(_ENC.encode(_text_of(m.get("content", "")),
+                                                          disallowed_special=()))
+    return total
+
+def prompt_budget(model: str) -> int:
+    """Jetons disponibles pour le prompt, sortie max (max_tokens) réservée."""
+    cfg = RAW_MODELS[model]
+    return cfg["context_window"] - cfg["max_tokens"] - REPLY_OVERHEAD
+
+def _max_out(cfg: dict, prompt_tokens: int) -> int:
+    """Sortie demandée : max_tokens, réduite si le prompt mord sur la fenêtre."""
+    return max(1, min(cfg["max_tokens"], cfg["context_window"] - prompt_tokens - REPLY_OVERHEAD))
+
+# ╔════════════════════════════  HTTP (pools keep-alive)  ═══════════════════╗
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "64"))   # par endpoint
+HTTP_KEEPALIVE_S     = float(os.getenv("HTTP_KEEPALIVE_S", "90"))
+HTTP2                = importlib.util.find_spec("h2") is not None
+
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=HTTP_MAX_CONNECTIONS))
+
+def http_session() -> requests.Session:
+    """Session sync partagée (thread-safe pour des POST simples)."""
+    return _session
+
+_lock_http = threading.Lock()
+_aclients: Dict[str, httpx.AsyncClient] = {}     # origine (scheme://host) → client
 
-def _rotate_on_fail(fam: str) -> None:
-    with _lock_ptr:
-        _ptr[fam] = (_ptr[fam] + 1) % len(RAW_MODELS[fam]["env_keys"])
+def async_client(url: str) -> httpx.AsyncClient:
+    """Client async poolé pour l’origine de `url` (créé au premier appel)."""
+    parts  = urlsplit(url)
+    origin = f"{parts.scheme}://{parts.netloc}"
+    with _lock_http:
+        client = _aclients.get(origin)
+        if client is None or client.is_closed:
+            client = _aclients[origin] = httpx.AsyncClient(
+                http2=HTTP2,
+                limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                                    max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+                                    keepalive_expiry=HTTP_KEEPALIVE_S),
+                timeout=httpx.Timeout(60, connect=10),
+            )
+        return client
+
+async def aclose_clients() -> None:
+    """À appeler à l’arrêt de l’application."""
+    with _lock_http:
+        clients = list(_aclients.values())
+        _aclients.clear()
+    await asyncio.gather(*(c.aclose() for c in clients), return_exceptions=True)
+
+def _json_headers(api_key: str) -> dict:
+    return {"api-key": api_key, "Content-Type": "application/json"}
+
+# ╔════════════════════════════  ROUTAGE (charge / latence / erreurs)  ═════╗
+def _registry(fam: str) -> Dict[str, object]:
+    return RAW_MODELS[fam] if fam in RAW_MODELS else EMBED_MODELS[fam]
+
+def _configured(fam: str) -> Dict[str, str]:
+    """endpoint → api_key des déploiements renseignés dans l’env."""
+    out: Dict[str, str] = {}
+    for api_env, end_env in _registry(fam)["env_keys"]:
+        api_key, endpoint = os.getenv(api_env), os.getenv(end_env)
+        if api_key and endpoint:
+            out[endpoint] = api_key
+    return out
+
+def _pickup_creds(fam: str, avoid: Iterable[str] = ()) -> Tuple[str, str, float]:
+    """(api_key, endpoint, attente) du meilleur déploiement selon le routeur
+    (hors `avoid` s’il reste une alternative)."""
+    creds = _configured(fam)
+    if not creds:
+        raise RuntimeError(f"Aucun déploiement configuré pour {fam}")
+    endpoint, wait = router.choose([ep for ep in creds if ep not in avoid] or creds)
+    return creds[endpoint], endpoint, wait
+
+def _observe_failure(ep: str, t0: float, resp, attempt: int) -> None:
+    """429 / 5xx / réseau → le déploiement refroidit ; autre 4xx : pas sa faute."""
+    status = resp.status_code if resp is not None else None
+    if status is None or status == 429 or status >= 500:
+        router.observe(ep, time.monotonic() - t0, False, _backoff(resp, attempt))
+
+def deployment_status(fam: str) -> List[dict]:
+    """Capacité restante + santé de chaque déploiement configuré (cf. /quota)."""
+    out = []
+    for ep in _configured(fam):
+        lim = get_limiter(ep)
+        out.append({
+            "resource":   (urlsplit(ep).hostname or "").split(".")[0],
+            "deployment": _registry(fam).get("deployment") or ep.rsplit("/", 3)[-3],
+            **(lim.capacity() if lim else {}),
+            **router.health(ep),
+        })
+    return out
+
+# ╔════════════════════════════  RATE LIMIT (RPM + TPM, par déploiement) ════╗
+#  Chaque appel réserve prompt estimé + max_tokens, puis `reconcile` sur
+#  l’usage réel (0 si l’appel a échoué : Azure ne facture pas les 429).
+def deployment_limiter(fam: str, endpoint: str) -> Limiter:
+    cfg = _registry(fam)
+    dep = cfg.get("deployment") or endpoint.rsplit("/", 3)[-3]
+    return limiter(endpoint, int(cfg["rpm"]), int(cfg["tpm"]), name=f"{fam} / {dep}")
+
+def _usage_tokens(data: dict, default: int) -> int:
+    return int((data.get("usage") or {}).get("total_tokens") or default)
 
 # ╔════════════════════════════  OUTILS Divers  ═════════════════════════════╗
 def _merge_system(msgs: List[dict]) -> List[dict]:
@@ -192,10 +325,10 @@ MAX_LOCAL_RETRY = 3          # ⇐ 1 essai + 2 retry = 3 au total
 BASE_BACKOFF    = 1.4        # facteur d’attente exponentielle
 
 # ─── helper
-def _sleep(resp, attempt):
-    hdr = resp.headers.get("Retry-After")
+def _backoff(resp, attempt) -> float:
+    hdr = resp.headers.get("Retry-After") if resp is not None else None
     wait = float(hdr) if hdr else BASE_BACKOFF * (BASE_BACKOFF ** attempt)
-    time.sleep(wait + random.random())
+    return wait + random.random()
 
 # ───────────────────────── helper vision ────────────────────────────────
 def _requires_vision(msgs: List[dict]) -> bool:
@@ -209,142 +342,647 @@ def _requires_vision(msgs: List[dict]) -> bool:
                 return True
     return False
 
+def _prepare_call(messages: List[dict], model: str) -> Tuple[str, dict, List[dict]]:
+    # ── Bascule auto Vision → GPT 4o
+    if _requires_vision(messages) and not model.startswith("GPT 4o"):
+        model = "GPT 4o"
+
+    cfg = RAW_MODELS[model]
+    if cfg.get("merge_system_into_user"):
+        messages = _merge_system(messages)
+    return model, cfg, messages
+
+def _chat_result(model: str, payload: dict, data: dict) -> Tuple[str, dict]:
+    deployment  = data.get("model") or payload["model"]
+    headers_out = {
+        "x-llm-model":      model,
+        "x-llm-deployment": deployment,
+    }
+    logger.info("LLM final=%s  deployment=%s  usage=%s",
+                model, deployment, data.get("usage", {}))
+    return data["choices"][0]["message"]["content"], headers_out
+
+def _stream_payload(cfg: dict, ep: str, messages: List[dict],
+                    prompt_tokens: int) -> dict:
+    return {
+        "messages": messages,
+        cfg["payload_key"]: _max_out(cfg, prompt_tokens),
+        "model": ep.rsplit("/", 3)[-3],
+        "stream": True,
+    }
+
+_SSE_DONE = object()
+
+def _sse_delta(raw: str):
+    """Ligne SSE → texte (str), None (rien à rendre) ou _SSE_DONE."""
+    if not raw or not raw.startswith("data: "):
+        return None
+    chunk = raw[6:]
+    if chunk.strip() == "[DONE]":
+        return _SSE_DONE
+    data = json.loads(chunk)
+    if data.get("choices"):
+        return data["choices"][0]["delta"].get("content")
+    return None
+
+# ╔════════════════════════════  CACHE DE RÉPONSES  ═════════════════════════╗
+#  Pour les appels déterministes (OCR, résumés, pré-passe vision…), sur option :
+#  cache="exact"    : clé = famille + messages normalisés (espaces)
+#  cache="semantic" : + si pas de clé exacte, dernière question vectorisée et
+#                     comparée (cosinus ≥ LLM_SEMANTIC_THRESHOLD) aux questions
+#                     déjà posées avec le même contexte (messages précédents)
+#  Stockage : DiskCache SQLite (TTL + LRU en octets) ; l’index sémantique est
+#  en mémoire et pointe vers les clés exactes.  Un hit ne consomme aucun quota.
+LLM_CACHE_TTL_S        = float(os.getenv("LLM_CACHE_TTL_S", str(7 * 24 * 3600)))
+LLM_CACHE_MAX_MB       = int(os.getenv("LLM_CACHE_MAX_MB", "256"))
+LLM_SEMANTIC_THRESHOLD = float(os.getenv("LLM_SEMANTIC_THRESHOLD", "0.97"))
+LLM_SEMANTIC_MAX       = int(os.getenv("LLM_SEMANTIC_MAX", "4096"))
+
+_RESPONSES = DiskCache("llm_responses", max_bytes=LLM_CACHE_MAX_MB * 2**20, ttl=LLM_CACHE_TTL_S)
+
+class _SemanticIndex:
+    """(famille + contexte) → vecteurs normalisés des dernières questions ; FIFO borné."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._lock   = threading.Lock()
+        self._groups: Dict[str, Tuple[List[str], List[np.ndarray]]] = {}
+        self._order: Deque[Tuple[str, str]] = deque()
+        self.hits = self.misses = 0
+        CACHES["llm_semantic"] = self
+
+    def add(self, group: str, key: str, vec: np.ndarray) -> None:
+        with self._lock:
+            keys, vecs = self._groups.setdefault(group, ([], []))
+            keys.append(key)
+            vecs.append(vec)
+            self._order.append((group, key))
+            while len(self._order) > self.maxsize:
+                g, k = self._order.popleft()
+                ks, vs = self._groups[g]
+                i = ks.index(k)
+                del ks[i], vs[i]
+                if not ks:
+                    del self._groups[g]
+
+    def search(self, group: str, vec: np.ndarray) -> Optional[str]:
+        with self._lock:
+            keys, vecs = self._groups.get(group, ([], []))
+            if keys:
+                sims = np.vstack(vecs) @ vec
+                i = int(np.argmax(sims))
+                if sims[i] >= LLM_SEMANTIC_THRESHOLD:
+                    self.hits += 1
+                    return keys[i]
+            self.misses += 1
+            return None
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {"size": len(self._order), "maxsize": self.maxsize,
+                    "threshold": LLM_SEMANTIC_THRESHOLD,
+                    "hits": self.hits, "misses": self.misses,
+                    "hit_rate": round(self.hits / total, 3) if total else None}
+
+_SEMANTIC = _SemanticIndex(LLM_SEMANTIC_MAX)
+
+def _norm_content(c):
+    if isinstance(c, list):
+        return [{**p, "text": " ".join(p["text"].split())} if p.get("type") == "text" else p
+                for p in c]
+    return " ".join(str(c).split())
+
+def _sha(obj) -> str:
+    return hashlib.sha256(json.dumps(obj, ensure_ascii=False, sort_keys=True).encode()).hexdigest()
+
+def _cache_lookup(model: str, messages: List[dict], mode: str):
+    """(résultat ou None, sonde à passer à _cache_store)."""
+    if mode not in ("exact", "semantic"):
+        raise ValueError(f"cache={mode!r} : 'exact' ou 'semantic'")
+    norm = [(m["role"], _norm_content(m.get("content", ""))) for m in messages]
+    key  = _sha([model, norm])
+    hit  = _RESPONSES.get(key)
+    if hit:
+        return (hit[0], {**hit[1], "x-llm-cache": "exact"}), None
+
+    group = vec = None
+    if mode == "semantic" and isinstance(norm[-1][1], str):       # pas de vision
+        group = _sha([model, norm[:-1]])
+        try:
+            from backend.embeddings import client as _embedder      # import tardif (cycle)
+            vec = np.asarray(_embedder.embed_query(norm[-1][1]), dtype=np.float32)
+            vec /= np.linalg.norm(vec) or 1.0
+        except Exception:
+            logger.warning("Cache sémantique indisponible", exc_info=True)
+        if vec is not None:
+            match = _SEMANTIC.search(group, vec)
+            hit   = _RESPONSES.get(match) if match else None
+            if hit:
+                return (hit[0], {**hit[1], "x-llm-cache": "semantic"}), None
+    return None, (key, group, vec)
+
+def _cache_store(probe, result: Tuple[str, dict]) -> None:
+    key, group, vec = probe
+    _RESPONSES.set(key, list(result))
+    if vec is not None:
+        _SEMANTIC.add(group, key, vec)
+
+# appels identiques en vol (même famille + messages) : une seule requête
+_chat_flights = SingleFlight("llm_chat")
+
 # ─── SYNC  (remplace entièrement azure_llm_chat)
 def azure_llm_chat(messages: List[dict],
-                   model: str = "GPT 4o") -> Tuple[str, dict]:
+                   model: str = "GPT 4o", *, hedge: bool = False,
+                   cache: str | None = None) -> Tuple[str, dict]:
     """
     Retourne (content, headers) où headers = {
         "x-llm-model":      "famille choisie",
         "x-llm-deployment": "nom exact du déploiement"
     }
+    hedge=True : doublon vers un autre déploiement si la réponse tarde (hedge.py).
+    cache="exact" | "semantic" : cache de réponses (+ header « x-llm-cache » si hit).
+    Les appels identiques simultanés partagent une seule requête (single-flight).
     """
-    # ── Bascule auto Vision → GPT 4o
-    if _requires_vision(messages) and not model.startswith("GPT 4o"):
-        model = "GPT 4o"
+    model, cfg, messages = _prepare_call(messages, model)
+    if cache:
+        hit, probe = _cache_lookup(model, messages, cache)
+        if hit:
+            return hit
 
-    cfg = RAW_MODELS[model]
-    if cfg.get("merge_system_into_user"):
-        messages = _merge_system(messages)
+    def _call() -> Tuple[str, dict]:
+        if hedge and HEDGE_ENABLED and len(_configured(model)) > 1:
+            result = _hedged_chat(messages, model, cfg)
+        else:
+            result = _chat(messages, model, cfg)
+        if cache:
+            _cache_store(probe, result)
+        return result
+    return _chat_flights.do(_sha([model, messages]), _call)
 
-    global_attempt = 0
-    while global_attempt < len(cfg["env_keys"]):
-        api_key, ep, rpm = _pickup_creds(model)
-        _wait_slot(ep, rpm)
-
-        for local_try in range(MAX_LOCAL_RETRY):
-            payload = {
-                "messages": messages,
-                cfg["payload_key"]: cfg["max_tokens"],
-                "model": ep.rsplit("/", 3)[-3],
-            }
-            try:
-                r = requests.post(
-                    ep,
-                    headers={"api-key": api_key, "Content-Type": "application/json"},
-                    json=payload, timeout=60,
-                )
-                r.raise_for_status()
-
-                data        = r.json()
-                deployment  = data.get("model") or payload["model"]
-                headers_out = {
-                    "x-llm-model":      model,
-                    "x-llm-deployment": deployment,
-                }
-                logger.info("LLM %s via %s (%s tok in/out)",
-                            model, deployment, data.get("usage", {}))
-                logger.info(
-                    "LLM final=%s  deployment=%s  usage=%s",
-                    model, deployment, data.get("usage", {})
-                )
-                return data["choices"][0]["message"]["content"], headers_out
-
-            except requests.HTTPError as exc:
-                if r.status_code in (429, 503):
-                    _sleep(r, local_try); continue
-                raise RuntimeError(f"Azure {r.status_code}: {exc}") from exc
-            except requests.RequestException:
-                _sleep(r, local_try); continue
+# les deux jambes d’un appel couvert tournent ici : pool dimensionné pour que
+# la file d’attente reste exceptionnelle (et elle n’entre pas dans le délai)
+HEDGE_POOL_SIZE = int(os.getenv("HEDGE_POOL_SIZE", "64"))
+_hedge_pool = cf.ThreadPoolExecutor(max_workers=HEDGE_POOL_SIZE, thread_name_prefix="hedge")
+
+def _hedged_chat(messages: List[dict], model: str, cfg: dict) -> Tuple[str, dict]:
+    # requests n’est pas annulable : le perdant finit sa requête en cours,
+    # puis `stop` l’empêche d’enchaîner les tentatives
+    sent: List[str] = []
+    started, stop = threading.Event(), threading.Event()
+
+    def _primary() -> Tuple[str, dict]:
+        started.set()
+        return _chat(messages, model, cfg, (), sent, stop)
+
+    primary = _hedge_pool.submit(bind(_primary))
+    started.wait()                            # délai compté depuis le vrai départ
+    try:
+        try:
+            return primary.result(timeout=hedger.delay(model))
+        except cf.TimeoutError:
+            if not hedger.allow():
+                return primary.result()
+        backup  = _hedge_pool.submit(bind(_chat), messages, model, cfg, tuple(sent), None, stop)
+        pending = {primary, backup}
+        while True:
+            done, pending = cf.wait(pending, return_when=cf.FIRST_COMPLETED)
+            ok = [f for f in done if f.exception() is None]
+            if ok:
+                if ok[0] is backup:
+                    hedger.won()
+                return ok[0].result()
+            if not pending:                   # les deux ont échoué
+                return primary.result()
+    finally:
+        stop.set()
+
+def _chat(messages: List[dict], model: str, cfg: dict,
+          avoid: Iterable[str] = (), sent: List[str] | None = None,
+          stop: threading.Event | None = None) -> Tuple[str, dict]:
+    prompt_tokens = _count_prompt_tokens(messages)
+    max_out       = _max_out(cfg, prompt_tokens)
+    estimate      = prompt_tokens + max_out
+
+    # chaque tentative re-choisit le déploiement (un 429 le met en pause)
+    for attempt in range(len(cfg["env_keys"]) * MAX_LOCAL_RETRY):
+        api_key, ep, wait = _pickup_creds(model, avoid)
+        if sent is not None:
+            sent.append(ep)
+        if wait:
+            time.sleep(wait) if stop is None else stop.wait(wait)
+        if stop is not None and stop.is_set():    # appel couvert déjà tranché
+            raise RuntimeError("Requête doublée abandonnée")
+        lim = deployment_limiter(model, ep)
+        payload = {
+            "messages": messages,
+            cfg["payload_key"]: max_out,
+            "model": ep.rsplit("/", 3)[-3],
+        }
+        reserved, used, r = lim.acquire(estimate), 0, None
+        router.begin(ep)
+        t0 = time.monotonic()
+        try:
+            r = _session.post(ep, headers=_json_headers(api_key), json=payload, timeout=60)
+            r.raise_for_status()
+            data = r.json()
+            used = _usage_tokens(data, reserved)
+            router.observe(ep, time.monotonic() - t0, True)
+            hedger.record(model, time.monotonic() - t0)
+            return _chat_result(model, payload, data)
 
-        _rotate_on_fail(model)
-        global_attempt += 1
+        except requests.HTTPError as exc:
+            _observe_failure(ep, t0, r, attempt)
+            if r.status_code not in (429, 503):
+                raise RuntimeError(f"Azure {r.status_code}: {exc}") from exc
+        except requests.RequestException:
+            _observe_failure(ep, t0, None, attempt)
+        finally:
+            router.release(ep)
+            lim.reconcile(reserved, used)
 
     raise RuntimeError(f"Toutes les tentatives ont échoué pour {model}")
 
 # ╔════════════════════════════  STREAM  ══════════════════════════════════╗
+#  Latence observée = délai jusqu’aux en-têtes ; « en cours » jusqu’à la fin.
+#  Reprise : si le flux cale (pas de jeton pendant STREAM_IDLE_TIMEOUT_S) ou
+#  se coupe sans [DONE], la requête repart sur un autre déploiement avec le
+#  texte déjà produit et la consigne de continuer ; la suite est raccordée
+#  (chevauchement éventuel retiré) – au plus STREAM_MAX_RESUMES reprises.
+STREAM_FIRST_TOKEN_TIMEOUT_S = float(os.getenv("STREAM_FIRST_TOKEN_TIMEOUT_S", "120"))  # o1/o3 réfléchissent
+STREAM_IDLE_TIMEOUT_S        = float(os.getenv("STREAM_IDLE_TIMEOUT_S", "30"))
+STREAM_MAX_RESUMES           = int(os.getenv("STREAM_MAX_RESUMES", "2"))
+
+_CONTINUE_PROMPT = (
+    "Ta réponse précédente a été interrompue. Continue-la exactement là où elle "
+    "s'arrête, sans rien répéter et sans introduction."
+)
+
+class StreamBroken(RuntimeError):
+    """Flux SSE coupé ou calé avant [DONE]."""
+
+def _continuation(messages: List[dict], partial: str) -> List[dict]:
+    return messages + [
+        {"role": "assistant", "content": partial},
+        {"role": "user",      "content": _CONTINUE_PROMPT},
+    ]
+
+class _Splicer:
+    """Retire, au début de la suite, ce qui répète la fin du texte déjà envoyé."""
+    HEAD, MIN_OVERLAP = 64, 12
+
+    def __init__(self, produced: str):
+        self.tail, self.buf, self.done = produced[-400:], "", False
+
+    def feed(self, delta: str) -> str:
+        if self.done:
+            return delta
+        self.buf += delta
+        return self.flush() if len(self.buf) >= self.HEAD else ""
+
+    def flush(self) -> str:
+        if self.done:
+            return ""
+        self.done = True
+        head = self.buf.lstrip() if self.tail[-1:].isspace() else self.buf
+        for k in range(min(len(self.tail), len(head)), self.MIN_OVERLAP - 1, -1):
+            if self.tail.endswith(head[:k]):
+                return head[k:]
+        return self.buf
+
+def _open_stream(messages: List[dict], model: str, cfg: dict, avoid: Iterable[str] = (),
+                 prompt_tokens: int | None = None):
+    if prompt_tokens is None:
+        prompt_tokens = _count_prompt_tokens(messages)
+
+    for attempt in range(len(cfg["env_keys"])):
+        api_key, ep, wait = _pickup_creds(model, avoid)
+        if wait:
+            time.sleep(wait)
+        lim = deployment_limiter(model, ep)
+
+        payload  = _stream_payload(cfg, ep, messages, prompt_tokens)
+        reserved = lim.acquire(prompt_tokens + payload[cfg["payload_key"]],
+                               cls=current_priority("interactive-stream"))
+        router.begin(ep)
+        t0, resp = time.monotonic(), None
+
+        try:
+            # timeout de lecture = premier jeton (borne le thread lecteur) ; le calage
+            # après le premier jeton est surveillé par _sse_deltas
+            resp = _session.post(ep, headers=_json_headers(api_key), json=payload, stream=True,
+                                 timeout=(10, STREAM_FIRST_TOKEN_TIMEOUT_S))
+            resp.raise_for_status()
+        except (requests.HTTPError, requests.RequestException):
+            _observe_failure(ep, t0, resp, attempt)
+            router.release(ep)
+            lim.reconcile(reserved, 0)
+            continue
+        router.observe(ep, time.monotonic() - t0, True)
+        return resp, ep, lim, reserved, prompt_tokens, payload["model"]
+
+    raise RuntimeError(f"Toutes les tentatives de streaming ont échoué pour {model}")
+
+_EOF = object()
+
+def _read_lines(resp, lines: "queue.Queue") -> None:
+    """Thread lecteur : lignes SSE → file (fin : _EOF, ou l’exception levée)."""
+    try:
+        for raw in resp.iter_lines(decode_unicode=True):
+            lines.put(raw)
+        lines.put(_EOF)
+    except Exception as exc:
+        lines.put(exc)
+
+def _sse_deltas(resp) -> Generator[str, None, None]:
+    """
+    Même échéancier que _sse_deltas_async : STREAM_FIRST_TOKEN_TIMEOUT_S
+    jusqu’au premier jeton, puis STREAM_IDLE_TIMEOUT_S par ligne. La lecture
+    bloquante tourne dans un thread (borné par le timeout de la requête),
+    l’attente est bornée ici.
+    """
+    lines: "queue.Queue" = queue.Queue()
+    threading.Thread(target=_read_lines, args=(resp, lines), daemon=True,
+                     name="sse-read").start()
+    timeout = STREAM_FIRST_TOKEN_TIMEOUT_S
+    while True:
+        try:
+            raw = lines.get(timeout=timeout)
+        except queue.Empty:
+            raise StreamBroken(f"aucun jeton depuis {timeout:g} s") from None
+        if raw is _EOF:
+            raise StreamBroken("flux fermé sans [DONE]")
+        if isinstance(raw, Exception):
+            raise raw
+        delta = _sse_delta(raw)
+        if delta is _SSE_DONE:
+            return
+        if delta:
+            timeout = STREAM_IDLE_TIMEOUT_S
+            yield delta
+
 def azure_llm_chat_stream(messages: List[dict],
-                          model: str = "GPT 4o") -> Tuple[Generator[str, None, None], dict]:
+                          model: str = "GPT 4o", *,
+                          prompt_tokens: int | None = None) -> Tuple[Generator[str, None, None], dict]:
     """
     Retourne (generator, headers) – headers idem que pour azure_llm_chat.
+    prompt_tokens : taille du prompt déjà connue (sinon recomptée).
     """
-    # ── Bascule auto Vision → GPT 4o
-    if _requires_vision(messages) and not model.startswith("GPT 4o"):
-        model = "GPT 4o"
+    model, cfg, messages = _prepare_call(messages, model)
+    opened      = _open_stream(messages, model, cfg, prompt_tokens=prompt_tokens)
+    headers_out = {"x-llm-model": model, "x-llm-deployment": opened[-1]}
 
-    cfg = RAW_MODELS[model]
-    if cfg.get("merge_system_into_user"):
-        messages = _merge_system(messages)
+    def _gen():
+        nonlocal opened
+        produced = ""
+        for resume in range(STREAM_MAX_RESUMES + 1):
+            resp, ep, lim, reserved, prompt_tokens, _ = opened
+            splice = _Splicer(produced) if produced else None
+            out: List[str] = []
+            t0 = time.monotonic()
+            try:
+                with resp:
+                    for delta in _sse_deltas(resp):
+                        out.append(delta)
+                        piece = splice.feed(delta) if splice else delta
+                        if piece:
+                            produced += piece
+                            yield piece
+                if splice and (piece := splice.flush()):
+                    produced += piece
+                    yield piece
+                return
+            except (StreamBroken, requests.RequestException, ValueError) as exc:
+                if resume == STREAM_MAX_RESUMES:
+                    raise StreamBroken(f"flux interrompu ({model}) : {exc}") from exc
+                logger.warning("Flux %s interrompu (%s) – reprise %d", model, exc, resume + 1)
+                router.observe(ep, time.monotonic() - t0, False, _backoff(None, resume))
+            finally:        # pas d’usage en streaming : on compte la sortie
+                router.release(ep)
+                lim.reconcile(reserved, prompt_tokens + len(_ENC.encode("".join(out), disallowed_special=())))
+            retry  = _continuation(messages, produced) if produced else messages
+            opened = _open_stream(retry, model, cfg, avoid=(ep,))
+    return _gen(), headers_out
+
+# ╔════════════════════════════  ASYNC  ═══════════════════════════════════╗
+#  Mêmes règles que les versions sync (routage, retry 429/503, RPM/TPM),
+#  sans bloquer de thread pendant la latence du LLM.
+async def azure_llm_chat_async(messages: List[dict],
+                               model: str = "GPT 4o", *, hedge: bool = False,
+                               cache: str | None = None,
+                               prompt_tokens: int | None = None) -> Tuple[str, dict]:
+    """
+    Version async de azure_llm_chat : retourne (content, headers).
+    prompt_tokens : taille du prompt déjà connue (sinon recomptée).
+    """
+    model, cfg, messages = _prepare_call(messages, model)
+    if cache:       # SQLite + éventuel embedding : hors de la boucle
+        hit, probe = await asyncio.to_thread(_cache_lookup, model, messages, cache)
+        if hit:
+            return hit
+
+    async def _call() -> Tuple[str, dict]:
+        if hedge and HEDGE_ENABLED and len(_configured(model)) > 1:
+            result = await _hedged_chat_async(messages, model, cfg, prompt_tokens)
+        else:
+            result = await _chat_async(messages, model, cfg, prompt_tokens=prompt_tokens)
+        if cache:
+            await asyncio.to_thread(_cache_store, probe, result)
+        return result
+    return await _chat_flights.do_async(_sha([model, messages]), _call)
+
+async def _hedged_chat_async(messages: List[dict], model: str, cfg: dict,
+                             prompt_tokens: int | None = None) -> Tuple[str, dict]:
+    sent: List[str] = []
+    primary = asyncio.ensure_future(_chat_async(messages, model, cfg, (), sent, prompt_tokens))
+    done, _ = await asyncio.wait({primary}, timeout=hedger.delay(model))
+    if done or not hedger.allow():
+        return await primary
+    backup  = asyncio.ensure_future(_chat_async(messages, model, cfg, tuple(sent),
+                                                prompt_tokens=prompt_tokens))
+    pending = {primary, backup}
+    try:
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            ok = [t for t in done if t.exception() is None]
+            if ok:
+                if ok[0] is backup:
+                    hedger.won()
+                return ok[0].result()
+            if not pending:                   # les deux ont échoué
+                return primary.result()
+    finally:
+        for task in pending:                  # le perdant est annulé (requête HTTP coupée)
+            task.cancel()
 
-    global_rot = 0
-    while global_rot < len(cfg["env_keys"]):
-        api_key, ep, rpm = _pickup_creds(model)
-        _wait_slot(ep, rpm)
-        
+async def _chat_async(messages: List[dict], model: str, cfg: dict,
+                      avoid: Iterable[str] = (), sent: List[str] | None = None,
+                      prompt_tokens: int | None = None) -> Tuple[str, dict]:
+    if prompt_tokens is None:
         prompt_tokens = _count_prompt_tokens(messages)
-        max_out = max(1, cfg["max_tokens"] - prompt_tokens)
+    max_out       = _max_out(cfg, prompt_tokens)
+    estimate      = prompt_tokens + max_out
+
+    for attempt in range(len(cfg["env_keys"]) * MAX_LOCAL_RETRY):
+        # le routeur lit la marge du rate-limit (sqlite / redis) : hors de la boucle
+        api_key, ep, wait = await asyncio.to_thread(_pickup_creds, model, avoid)
+        if sent is not None:
+            sent.append(ep)
+        if wait:
+            await asyncio.sleep(wait)
+        lim = deployment_limiter(model, ep)
         payload = {
             "messages": messages,
             cfg["payload_key"]: max_out,
             "model": ep.rsplit("/", 3)[-3],
-            "stream": True,
         }
-        deployment = payload["model"]
-        headers_out = {"x-llm-model": model, "x-llm-deployment": deployment}
-
+        reserved, used, r = await lim.acquire_async(estimate), 0, None
+        router.begin(ep)
+        t0 = time.monotonic()
         try:
-            resp = requests.post(
-                ep,
-                headers={"api-key": api_key, "Content-Type": "application/json"},
-                json=payload, stream=True, timeout=90,
-            )
-            resp.raise_for_status()
+            r = await async_client(ep).post(ep, headers=_json_headers(api_key), json=payload)
+            r.raise_for_status()
+            data = r.json()
+            used = _usage_tokens(data, reserved)
+            router.observe(ep, time.monotonic() - t0, True)
+            hedger.record(model, time.monotonic() - t0)
+            return _chat_result(model, payload, data)
 
-            def _gen():
-                for raw in resp.iter_lines(decode_unicode=True):
-                    if not raw or not raw.startswith("data: "):
-                        continue
-                    chunk = raw[6:]
-                    if chunk.strip() == "[DONE]":
-                        return
-                    data = json.loads(chunk)
-                    if data.get("choices"):
-                        delta = data["choices"][0]["delta"].get("content")
-                        if delta: yield delta
-            return _gen(), headers_out
+        except httpx.HTTPStatusError as exc:
+            _observe_failure(ep, t0, r, attempt)
+            if r.status_code not in (429, 503):
+                raise RuntimeError(f"Azure {r.status_code}: {exc}") from exc
+        except httpx.HTTPError:
+            _observe_failure(ep, t0, None, attempt)
+        finally:
+            router.release(ep)
+            await lim.reconcile_async(reserved, used)
 
-        except (requests.HTTPError, requests.RequestException):
-            _rotate_on_fail(model)
-            global_rot += 1
+    raise RuntimeError(f"Toutes les tentatives ont échoué pour {model}")
+
+async def _open_stream_async(messages: List[dict], model: str, cfg: dict,
+                             avoid: Iterable[str] = (), prompt_tokens: int | None = None):
+    if prompt_tokens is None:
+        prompt_tokens = _count_prompt_tokens(messages)
+
+    for attempt in range(len(cfg["env_keys"])):
+        # le routeur lit la marge du rate-limit (sqlite / redis) : hors de la boucle
+        api_key, ep, wait = await asyncio.to_thread(_pickup_creds, model, avoid)
+        if wait:
+            await asyncio.sleep(wait)
+        lim = deployment_limiter(model, ep)
+
+        payload  = _stream_payload(cfg, ep, messages, prompt_tokens)
+        client   = async_client(ep)
+        reserved = await lim.acquire_async(prompt_tokens + payload[cfg["payload_key"]],
+                                           cls=current_priority("interactive-stream"))
+        router.begin(ep)
+        t0, resp = time.monotonic(), None
+
+        try:
+            req  = client.build_request(
+                "POST", ep, headers=_json_headers(api_key), json=payload,
+                timeout=httpx.Timeout(STREAM_FIRST_TOKEN_TIMEOUT_S + 10, connect=10))
+            resp = await client.send(req, stream=True)
+            if resp.is_error:
+                await resp.aclose()
+                resp.raise_for_status()
+        except httpx.HTTPError:
+            _observe_failure(ep, t0, resp, attempt)
+            router.release(ep)
+            await lim.reconcile_async(reserved, 0)
             continue
+        router.observe(ep, time.monotonic() - t0, True)
+        return resp, ep, lim, reserved, prompt_tokens, payload["model"]
 
     raise RuntimeError(f"Toutes les tentatives de streaming ont échoué pour {model}")
 
+async def _sse_deltas_async(resp) -> AsyncGenerator[str, None]:
+    lines   = resp.aiter_lines()
+    timeout = STREAM_FIRST_TOKEN_TIMEOUT_S
+    while True:
+        try:
+            raw = await asyncio.wait_for(lines.__anext__(), timeout)
+        except StopAsyncIteration:
+            raise StreamBroken("flux fermé sans [DONE]") from None
+        except asyncio.TimeoutError:
+            raise StreamBroken(f"aucun jeton depuis {timeout:g} s") from None
+        delta = _sse_delta(raw)
+        if delta is _SSE_DONE:
+            return
+        if delta:
+            timeout = STREAM_IDLE_TIMEOUT_S
+            yield delta
+
+async def azure_llm_chat_stream_async(
+    messages: List[dict], model: str = "GPT 4o", *, prompt_tokens: int | None = None,
+) -> Tuple[AsyncGenerator[str, None], dict]:
+    """Version async de azure_llm_chat_stream : (async generator, headers)."""
+    model, cfg, messages = _prepare_call(messages, model)
+    opened      = await _open_stream_async(messages, model, cfg, prompt_tokens=prompt_tokens)
+    headers_out = {"x-llm-model": model, "x-llm-deployment": opened[-1]}
+
+    async def _agen():
+        nonlocal opened
+        produced = ""
+        for resume in range(STREAM_MAX_RESUMES + 1):
+            resp, ep, lim, reserved, prompt_tokens, _ = opened
+            splice = _Splicer(produced) if produced else None
+            out: List[str] = []
+            t0 = time.monotonic()
+            try:
+                async for delta in _sse_deltas_async(resp):
+                    out.append(delta)
+                    piece = splice.feed(delta) if splice else delta
+                    if piece:
+                        produced += piece
+                        yield piece
+                if splice and (piece := splice.flush()):
+                    produced += piece
+                    yield piece
+                return
+            except (StreamBroken, httpx.HTTPError, ValueError) as exc:
+                if resume == STREAM_MAX_RESUMES:
+                    raise StreamBroken(f"flux interrompu ({model}) : {exc}") from exc
+                logger.warning("Flux %s interrompu (%s) – reprise %d", model, exc, resume + 1)
+                router.observe(ep, time.monotonic() - t0, False, _backoff(None, resume))
+            finally:
+                await resp.aclose()           # connexion rendue au pool
+                router.release(ep)
+                await lim.reconcile_async(reserved, prompt_tokens + len(_ENC.encode("".join(out), disallowed_special=())))
+            retry  = _continuation(messages, produced) if produced else messages
+            opened = await _open_stream_async(retry, model, cfg, avoid=(ep,))
+    return _agen(), headers_out
+
 # ╔════════════════════════════  OCR ‹ GPT-4o vision ›  ════════════════════╗
-def gpt4o_ocr(image_bytes: bytes, mime: str = "image/png") -> str:
-    """
-    Renvoie la transcription exacte de tout le texte présent sur l’image.
-    Utilise GPT-4o vision (même déploiement que le chat).
-    """
+def _ocr_messages(image_bytes: bytes, mime: str) -> List[dict]:
     b64 = base64.b64encode(image_bytes).decode()
-    prompt = [
+    return [
         {"role": "user", "content": [
             {"type": "text",
              "text": "Transcris exactement tout le texte présent sur l'image."},
             {"type": "image_url",
              "image_url": {"url": f"data:{mime};base64,{b64}"}}]}
     ]
+
+def gpt4o_ocr(image_bytes: bytes, mime: str = "image/png") -> str:
+    """
+    Renvoie la transcription exacte de tout le texte présent sur l’image.
+    Utilise GPT-4o vision (même déploiement que le chat).
+    """
+    prompt = _ocr_messages(image_bytes, mime)
     try:
-        txt, _ = azure_llm_chat(prompt, model="GPT 4o")
+        txt, _ = azure_llm_chat(prompt, model="GPT 4o", hedge=True, cache="exact")
+        return txt.strip()
+    except Exception as exc:
+        logger.exception("Vision OCR failure")
+        raise HTTPException(502, "Erreur GPT-4o Vision") from exc
+
+async def gpt4o_ocr_async(image_bytes: bytes, mime: str = "image/png") -> str:
+    """Version async de gpt4o_ocr."""
+    prompt = _ocr_messages(image_bytes, mime)
+    try:
+        txt, _ = await azure_llm_chat_async(prompt, model="GPT 4o", hedge=True, cache="exact")
         return txt.strip()
     except Exception as exc:
         logger.exception("Vision OCR failure")
@@ -358,24 +996,38 @@ def dalle3_generate(prompt: str, size: str = "1024x1024") -> str:
     Variables requises dans .env :
       AZ_dall-e-3_API, AZ_dall-e-3_ENDPOINT  (configurées par l’utilisateur)
     """
-    api_key  = os.getenv("AZ_DALLE3_API_KEY")
-    endpoint = os.getenv("AZ_DALLE3_ENDPOINT")
-    if not api_key or not endpoint:
-        raise RuntimeError("Variables AZ_dall-e-3_API / AZ_dall-e-3_ENDPOINT manquantes")
-
+    api_key, endpoint = _dalle3_creds()
     payload = {"prompt": prompt, "n": 1, "size": size}
-    r = requests.post(endpoint, headers={
-                      "api-key": api_key, "Content-Type": "application/json"},
-                      json=payload, timeout=60)
+    r = _session.post(endpoint, headers=_json_headers(api_key), json=payload, timeout=60)
     try:
         r.raise_for_status()
         return r.json()["data"][0]["url"]
     except requests.HTTPError as exc:
-        resp_text = r.text             # <── on capture ici
-        # Slack sur les refus de policy : on redescend un 400 générique
-        if r.status_code == 400 and "content_policy_violation" in resp_text:
-            raise HTTPException(400, "Prompt bloqué par la politique de sûreté") from exc
-
-        msg = f"DALL·E error {r.status_code}: {resp_text}"
-        logger.error(msg)
-        raise HTTPException(r.status_code, msg) from exc
+        _dalle3_error(r.status_code, r.text, exc)
+
+async def dalle3_generate_async(prompt: str, size: str = "1024x1024") -> str:
+    """Version async de dalle3_generate."""
+    api_key, endpoint = _dalle3_creds()
+    payload = {"prompt": prompt, "n": 1, "size": size}
+    r = await async_client(endpoint).post(endpoint, headers=_json_headers(api_key), json=payload)
+    try:
+        r.raise_for_status()
+        return r.json()["data"][0]["url"]
+    except httpx.HTTPStatusError as exc:
+        _dalle3_error(r.status_code, r.text, exc)
+
+def _dalle3_creds() -> Tuple[str, str]:
+    api_key  = os.getenv("AZ_DALLE3_API_KEY")
+    endpoint = os.getenv("AZ_DALLE3_ENDPOINT")
+    if not api_key or not endpoint:
+        raise RuntimeError("Variables AZ_dall-e-3_API / AZ_dall-e-3_ENDPOINT manquantes")
+    return api_key, endpoint
+
+def _dalle3_error(status: int, resp_text: str, exc: Exception):
+    # Slack sur les refus de policy : on redescend un 400 générique
+    if status == 400 and "content_policy_violation" in resp_text:
+        raise HTTPException(400, "Prompt bloqué par la politique de sûreté") from exc
+
+    msg = f"DALL·E error {status}: {resp_text}"
+    logger.error(msg)
+    raise HTTPException(status, msg) from exc
@@ -1,57 +1,153 @@
-import io, os
-import pandas as pd
-import docx2txt
-from PyPDF2 import PdfReader
+import os, re, json, asyncio, logging, unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 
-from langchain.text_splitter import CharacterTextSplitter
-from langchain_community.vectorstores import FAISS
-from langchain_openai.embeddings.azure import AzureOpenAIEmbeddings
-from backend.model import azure_llm_chat     # ⬅️ appel à ton wrapper
+from backend.model import azure_llm_chat, azure_llm_chat_async, _ENC, _sha     # ⬅️ appel à ton wrapper
+from backend.singleflight import SingleFlight
+from backend.scheduler import bind
+from backend.embeddings import client as embedding_client
+
+from backend.tables import run_query
+from backend.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Parsing : cf. backend/parsing.py (pool de process) – ré-exporté ici
+from backend.parsing import (
+    parse_pdf, parse_docx, parse_txt, parse_excel, parse_document, PARSER_VERSION,
+)
 
 # ---------------------------------------------------------------------------
-#  PARSING fichiers ----------------------------------------------------------
+#  VECTORIZING / RAG ---------------------------------------------------------
 # ---------------------------------------------------------------------------
 
-def parse_pdf(file_bytes: bytes) -> str:
-    pdf_reader = PdfReader(io.BytesIO(file_bytes))
-    return "\n".join(page.extract_text() or "" for page in pdf_reader.pages)
+# Découpage en TOKENS (même encodeur cl100k_base que l’API / ada-002) :
+#  • unités = lignes (une ligne CSV n’est jamais coupée)
+#  • un titre (markdown « # », « 1.2 Titre », LIGNE EN CAPITALES) ouvre un morceau
+#  • on coupe de préférence sur une ligne vide (fin de paragraphe)
+#  • une ligne plus longue qu’un morceau (PDF sans retours) est coupée en
+#    fenêtres de tokens, offsets exacts via decode_with_offsets
+#  • une seule tokenisation par ligne → temps linéaire en la taille du texte
+CHUNK_TOKENS  = 256
+CHUNK_OVERLAP = 48
 
-def parse_docx(file_bytes: bytes) -> str:
-    return docx2txt.process(io.BytesIO(file_bytes))
+_HEADING = re.compile(r"^\s{0,3}(#{1,6}\s+\S|\d+(\.\d+)*[.)]?\s+[A-ZÀ-Ý]|[A-ZÀ-Ý][A-ZÀ-Ý0-9 '’\-]{3,60}$)")
 
-def parse_txt(file_bytes: bytes) -> str:
-    return file_bytes.decode("utf-8", errors="ignore")
+@dataclass(frozen=True)
+class Chunk:
+    text:  str
+    start: int          # offsets caractères dans le texte source : text == source[start:end]
+    end:   int
 
-def parse_excel(file_bytes: bytes) -> str:
-    file_obj = io.BytesIO(file_bytes)
-    try:
-        df = pd.read_excel(file_obj)
-    except Exception:
-        file_obj.seek(0)
-        df = pd.read_csv(file_obj)
-    return df.to_csv(index=False)
+def _lines(text: str) -> list[tuple[int, int]]:
+    """(début, fin) de chaque ligne, saut de ligne inclus."""
+    out, pos = [], 0
+    for line in text.splitlines(keepends=True):
+        out.append((pos, pos + len(line)))
+        pos += len(line)
+    return out
 
-# ---------------------------------------------------------------------------
-#  VECTORIZING / RAG ---------------------------------------------------------
-# ---------------------------------------------------------------------------
+def _split_long(text: str, start: int, end: int, size: int, overlap: int) -> list[tuple[int, int]]:
+    """Fenêtres de `size` tokens (recouvrement `overlap`) d’une ligne trop longue."""
+    toks = _ENC.encode_ordinary(text[start:end])
+    _, offs = _ENC.decode_with_offsets(toks)
+    offs = [start + o for o in offs] + [end]
+    step = max(1, size - overlap)
+    return [(offs[i], offs[min(i + size, len(toks))]) for i in range(0, len(toks), step)
+            if i == 0 or i + overlap < len(toks)]
+
+# lignes courtes : encodage direct (le batch coûte ~30 µs d’aiguillage par ligne) ;
+# seules les longues lignes partent en batch (threads tiktoken)
+_BATCH_MIN_CHARS = 4096
+
+def _line_counts(text: str, spans: list[tuple[int, int]]) -> list[int]:
+    counts = [0 if b - a >= _BATCH_MIN_CHARS else len(_ENC.encode_ordinary(text[a:b]))
+              for a, b in spans]
+    long_ = [i for i, (a, b) in enumerate(spans) if b - a >= _BATCH_MIN_CHARS]
+    if long_:
+        toks = _ENC.encode_ordinary_batch([text[spans[i][0]:spans[i][1]] for i in long_])
+        for i, t in zip(long_, toks):
+            counts[i] = len(t)
+    return counts
+
+def chunk_text(text: str, chunk_tokens: int = CHUNK_TOKENS,
+               overlap: int = CHUNK_OVERLAP) -> list[Chunk]:
+    spans   = _lines(text)
+    counts  = _line_counts(text, spans)
+
+    # unités : lignes, les trop longues étant pré-découpées
+    units: list[tuple[int, int, int, bool, bool]] = []   # (début, fin, tokens, titre, paragraphe fini)
+    for (a, b), n in zip(spans, counts):
+        line = text[a:b]
+        blank_after = not line.strip()
+        if n > chunk_tokens:
+            for sa, sb in _split_long(text, a, b, chunk_tokens, overlap):
+                units.append((sa, sb, chunk_tokens, False, False))
+        else:
+            units.append((a, b, n, bool(_HEADING.match(line)), blank_after))
 
-def get_text_chunks(text: str, chunk_size: int = 1_000, overlap: int = 200) -> list[str]:
-    splitter = CharacterTextSplitter(separator="\n", chunk_size=chunk_size, chunk_overlap=overlap)
-    return splitter.split_text(text)
+    chunks: list[Chunk] = []
+    cur: list[tuple[int, int, int, bool, bool]] = []
+    cur_tok = 0
 
-def build_vectorstore_from_texts(texts: list[str]) -> FAISS:
-    if not texts:
-        texts = [""]
-    embedding = AzureOpenAIEmbeddings(
-        api_key         = os.getenv("AZ_OPENAI_API_4o_mini_ada_002"),
-        azure_endpoint  = os.getenv("AZURE_OPENAI_EMBEDDINGS_ENDPOINT"),
-        model           = "text-embedding-ada-002",
-        openai_api_version = "2023-05-15",
-    )
-    return FAISS.from_texts(texts=texts, embedding=embedding)
+    def _emit() -> None:
+        a, b = cur[0][0], cur[-1][1]
+        if text[a:b].strip():
+            chunks.append(Chunk(text[a:b], a, b))
 
-def search_documents(vs: FAISS, query: str, k: int = 4) -> list[str]:
-    return [doc.page_content for doc in vs.similarity_search(query, k=k)]
+    for u in units:
+        _, _, n, heading, _ = u
+        full = cur and cur_tok + n > chunk_tokens
+        if cur and (full or (heading and cur_tok > chunk_tokens // 4)):
+            # coupe de préférence après la dernière fin de paragraphe
+            cut, acc = len(cur), cur_tok             # acc = tokens de cur[:i + 1]
+            if full:
+                for i in range(len(cur) - 1, 0, -1):
+                    if cur[i][4] and acc >= chunk_tokens // 2:
+                        cut = i + 1
+                        break
+                    acc -= cur[i][2]
+            rest, cur = cur[cut:], cur[:cut]
+            _emit()
+            # recouvrement : dernières lignes (≤ overlap tokens), sauf avant un titre
+            tail: list = []
+            if not heading:
+                t = 0
+                for x in reversed(cur):
+                    if x[2] + t > overlap:
+                        break
+                    tail.insert(0, x)
+                    t += x[2]
+            cur = tail + rest
+            cur_tok = sum(x[2] for x in cur)
+            if cur_tok + n > chunk_tokens:           # le recouvrement ne tient plus : abandonné
+                cur, cur_tok = rest, sum(x[2] for x in rest)
+                if cur and cur_tok + n > chunk_tokens:
+                    _emit()
+                    cur, cur_tok = [], 0
+        cur.append(u)
+        cur_tok += n
+    if cur:
+        _emit()
+    return chunks
+
+def get_text_chunks(text: str, chunk_size: int = CHUNK_TOKENS, overlap: int = CHUNK_OVERLAP) -> list[str]:
+    """Morceaux de `chunk_size` tokens (cf. chunk_text pour les offsets)."""
+    return [c.text for c in chunk_text(text, chunk_size, overlap)]
+
+EMBED_MODEL = "text-embedding-ada-002"
+
+# même fichier ouvert / même question en parallèle : un seul appel en vol
+_embed_flights   = SingleFlight("embeddings")
+_summary_flights = SingleFlight("summaries")
+
+def embed_texts(texts: list[str]) -> list[list[float]]:
+    """Vectorise une liste de morceaux (ingestion) – lots concurrents."""
+    return _embed_flights.do(_sha(["texts", texts]), embedding_client.embed, texts)
+
+def embed_query(query: str) -> list[float]:
+    """Vectorise la question (seul appel d’embedding au tour de chat)."""
+    return _embed_flights.do(_sha(["query", query]), embedding_client.embed_query, query)
 
 # ---------------------------------------------------------------------------
 #  RÉSUMÉ automatique – utilisé dès l’upload --------------------------------
@@ -61,14 +157,224 @@ _SUM_SYS = (
     "Tu es un assistant qui produit un résumé **objectif** et **synthétique** du "
     "document fourni (200 mots max, pas d’invention)."
 )
+_MAP_SYS = (
+    "Tu résumes un EXTRAIT d’un document plus long. Conserve les faits, chiffres, "
+    "noms et dates importants (150 mots max, pas d’invention)."
+)
+_REDUCE_SYS = (
+    "Tu fusionnes des résumés partiels successifs d’un même document en un seul "
+    "résumé fidèle, sans redite (200 mots max, pas d’invention)."
+)
 
-def summarize_text(text: str) -> str:
-    # on tronque si vraiment énorme (évite > 130 k tokens)
-    text = text[:120_000]
+# ─── petits documents : un seul appel (comme avant)
+SUMMARY_MODEL = "GPT o1-mini"
+
+# ─── grands documents : map-reduce hiérarchique
+SUMMARY_MAP_MODEL     = os.getenv("SUMMARY_MAP_MODEL", "GPT 4o-mini")
+SUMMARY_STAGE_TOKENS  = int(os.getenv("SUMMARY_STAGE_TOKENS", "12000"))   # entrée max / appel map
+SUMMARY_REDUCE_TOKENS = int(os.getenv("SUMMARY_REDUCE_TOKENS", "8000"))   # entrée max / appel reduce
+SUMMARY_FANOUT        = int(os.getenv("SUMMARY_FANOUT", "8"))             # résumés fusionnés / appel
+SUMMARY_PARALLEL      = int(os.getenv("SUMMARY_PARALLEL", "8"))
+
+# entre dans la clé du cache documents (ingest.py) : changer un modèle ou un
+# budget invalide les résumés déjà calculés
+SUMMARY_VERSION = (f"{SUMMARY_MODEL}|{SUMMARY_MAP_MODEL}|{SUMMARY_STAGE_TOKENS}|"
+                   f"{SUMMARY_REDUCE_TOKENS}|{SUMMARY_FANOUT}")
+
+_sum_pool = ThreadPoolExecutor(max_workers=max(1, SUMMARY_PARALLEL), thread_name_prefix="summary")
+
+def _llm_summary(sys: str, text: str, model: str) -> str:
     return azure_llm_chat(
         [
-            {"role": "system", "content": _SUM_SYS},
+            {"role": "system", "content": sys},
             {"role": "user",   "content": text},
         ],
-        model="GPT o1-mini",
-    )
+        model=model, hedge=True, cache="exact",
+    )[0]
+
+def _groups(parts: list[str], max_tokens: int, fanout: int) -> list[list[str]]:
+    """Regroupe des résumés consécutifs : ≤ fanout éléments et ≤ max_tokens."""
+    groups: list[list[str]] = []
+    cur, cur_tok = [], 0
+    for part, n in zip(parts, map(len, _ENC.encode_batch(parts, disallowed_special=()))):
+        # ≥ 2 éléments par paquet : chaque niveau réduit forcément le nombre de résumés
+        if len(cur) >= fanout or (len(cur) >= 2 and cur_tok + n > max_tokens):
+            groups.append(cur)
+            cur, cur_tok = [], 0
+        cur.append(part)
+        cur_tok += n
+    if cur:
+        groups.append(cur)
+    return groups
+
+def summarize_text(
+    text: str,
+    *,
+    stage_tokens:  int = SUMMARY_STAGE_TOKENS,
+    reduce_tokens: int = SUMMARY_REDUCE_TOKENS,
+    fanout:        int = SUMMARY_FANOUT,
+) -> str:
+    """
+    Résumé de tout le document.
+    • ≤ stage_tokens : un appel direct à SUMMARY_MODEL
+    • sinon : map (extraits de stage_tokens, en parallèle, modèle léger)
+      puis reduce par paquets de `fanout` jusqu’à un seul résumé
+    """
+    if not text.strip():
+        return ""
+    key = _sha([SUMMARY_VERSION, stage_tokens, reduce_tokens, fanout, text])
+    return _summary_flights.do(key, _summarize, text, stage_tokens, reduce_tokens, fanout)
+
+def _summarize(text: str, stage_tokens: int, reduce_tokens: int, fanout: int) -> str:
+    toks = _ENC.encode(text, disallowed_special=())
+    if len(toks) <= stage_tokens:
+        return _llm_summary(_SUM_SYS, text, SUMMARY_MODEL)
+
+    # ── map
+    parts = [_ENC.decode(toks[i:i + stage_tokens]) for i in range(0, len(toks), stage_tokens)]
+    partials = list(_sum_pool.map(bind(lambda p: _llm_summary(_MAP_SYS, p, SUMMARY_MAP_MODEL)), parts))
+
+    # ── reduce (hiérarchique)
+    while True:
+        groups = _groups(partials, reduce_tokens, max(2, fanout))
+        if len(groups) == 1:
+            return _llm_summary(_SUM_SYS, "\n\n".join(groups[0]), SUMMARY_MAP_MODEL)
+        partials = list(_sum_pool.map(
+            bind(lambda g: _llm_summary(_REDUCE_SYS, "\n\n".join(g), SUMMARY_MAP_MODEL)), groups))
+
+# ---------------------------------------------------------------------------
+#  TABLEAUX – question → plan JSON → pandas (cf. backend/tables.py) ---------
+# ---------------------------------------------------------------------------
+
+TABLE_PLAN_MODEL = "GPT 4o-mini"
+
+#   • filtre local d’abord : un tableau n’est planifié que si la question
+#     partage un mot avec son nom / ses colonnes / ses valeurs d’exemple
+#   • un seul appel LLM pour tous les tableaux retenus (un plan chacun)
+#   • plans mis en cache par (tableau, question normalisée)
+_PLAN_SYS = (
+    "Tu traduis une question en requêtes sur des tableaux numérotés. Réponds "
+    "UNIQUEMENT par un objet JSON {\"plans\": [...]} avec, pour CHAQUE tableau :\n"
+    '{"table": n, "relevant": bool, "columns": [..], "filters": [{"column", "op", "value"}], '
+    '"group_by": [..], "aggregations": [{"column", "func"}], '
+    '"sort": {"column", "desc"}, "limit": n}\n'
+    "op ∈ ==, !=, >, >=, <, <=, contains, in ; func ∈ sum, mean, min, max, count, "
+    "nunique, median (column \"*\" + func count = nombre de lignes). "
+    "Utilise exactement les noms de colonnes du schéma du tableau. "
+    "relevant=false si la question ne porte pas sur ce tableau."
+)
+
+_PLANS   = TTLCache("table_plans", maxsize=1_024, ttl=3600)
+_NO_PLAN = object()          # absent du cache (≠ None : tableau non concerné)
+
+_WORD = re.compile(r"[0-9a-z]{3,}")
+_STOP = {
+    "les", "des", "une", "est", "que", "qui", "quel", "quelle", "quels", "quelles",
+    "dans", "pour", "par", "sur", "avec", "sans", "entre", "plus", "moins", "combien",
+    "etre", "cette", "ces", "aux", "leur", "leurs", "tout", "tous",
+    "comment", "quoi", "mon", "mes", "ton", "tes", "son", "ses", "nous", "vous", "elle",
+    "ils", "sont", "ont", "peux", "peut", "fait", "faire", "the", "and", "what", "how",
+    "many", "much", "which", "with", "from", "this", "that", "are", "for",
+}
+
+def _words(text: str) -> set[str]:
+    """Mots normalisés (minuscules sans accents, pluriel « s » retiré, mots vides exclus)."""
+    text = unicodedata.normalize("NFKD", text.lower()).encode("ascii", "ignore").decode()
+    return {w.rstrip("s") for w in _WORD.findall(text) if w not in _STOP}
+
+def _table_may_match(doc: dict, question: str) -> bool:
+    vocab = _words(doc["name"] + "\n" + doc["table"]["schema"])
+    return bool(_words(question) & vocab)
+
+def _plan_key(table: dict, question: str) -> tuple[str, str]:
+    return table["key"], " ".join(question.lower().split())
+
+def _plan_messages(docs: list[dict], question: str) -> list[dict]:
+    schemas = "\n\n".join(f"## Tableau {n}\n{d['table']['schema']}" for n, d in enumerate(docs))
+    return [
+        {"role": "system", "content": _PLAN_SYS},
+        {"role": "user",   "content": f"{schemas}\n\nQuestion : {question}"},
+    ]
+
+def _parse_plans(raw: str, n_tables: int) -> list[dict | None]:
+    raw = raw.strip().removeprefix("```json").removeprefix("```").removesuffix("```")
+    plans: list[dict | None] = [None] * n_tables
+    try:
+        items = json.loads(raw).get("plans", [])
+    except (json.JSONDecodeError, AttributeError):
+        logger.warning("Plans tableaux illisibles : %s", raw[:200])
+        return plans
+    for p in items:
+        if isinstance(p, dict) and isinstance(p.get("table"), int) and 0 <= p["table"] < n_tables:
+            plans[p["table"]] = p if p.get("relevant") else None
+    return plans
+
+def _cached_plans(docs: list[dict], question: str) -> tuple[list, list[int]]:
+    plans = [_PLANS.get(_plan_key(d["table"], question), _NO_PLAN) for d in docs]
+    return plans, [i for i, p in enumerate(plans) if p is _NO_PLAN]
+
+def _fill_plans(docs: list[dict], question: str, plans: list,
+                todo: list[int], raw: str) -> list[dict | None]:
+    for i, plan in zip(todo, _parse_plans(raw, len(todo))):
+        plans[i] = plan
+        _PLANS.set(_plan_key(docs[i]["table"], question), plan)
+    return plans
+
+def table_query_plans(docs: list[dict], question: str) -> list[dict | None]:
+    """Un plan (ou None) par document-tableau de `docs` – au plus un appel LLM."""
+    plans, todo = _cached_plans(docs, question)
+    if not todo:
+        return plans
+    raw = azure_llm_chat(_plan_messages([docs[i] for i in todo], question),
+                         model=TABLE_PLAN_MODEL, cache="exact")[0]
+    return _fill_plans(docs, question, plans, todo, raw)
+
+async def table_query_plans_async(docs: list[dict], question: str) -> list[dict | None]:
+    """Version async de table_query_plans."""
+    plans, todo = _cached_plans(docs, question)
+    if not todo:
+        return plans
+    raw = (await azure_llm_chat_async(_plan_messages([docs[i] for i in todo], question),
+                                      model=TABLE_PLAN_MODEL, cache="exact"))[0]
+    return _fill_plans(docs, question, plans, todo, raw)
+
+def _run_plans(docs: list[dict], plans: list[dict | None]) -> str:
+    out: list[str] = []
+    for d, plan in zip(docs, plans):
+        if not plan:
+            continue
+        try:
+            out.append(f"### {d['name']}\n{run_query(d['table'], plan)}")
+        except ValueError as exc:           # plan rejeté : le dire plutôt que se taire
+            logger.warning("Plan tableau %s rejeté : %s", d["name"], exc)
+            out.append(f"### {d['name']}\nRequête impossible : {exc}")
+        except Exception:
+            logger.exception("Requête tableau %s impossible", d["name"])
+    return "\n\n".join(out)
+
+def _candidate_tables(docs: list[dict], question: str) -> list[dict]:
+    return [d for d in docs if d.get("table") and _table_may_match(d, question)]
+
+def answer_from_tables(docs: list[dict], question: str) -> str:
+    """Résultats (petits) des requêtes pandas sur les tableaux concernés."""
+    tables = _candidate_tables(docs, question)
+    if not tables:
+        return ""
+    try:
+        plans = table_query_plans(tables, question)
+    except Exception:
+        logger.exception("Planification des tableaux impossible")
+        return ""
+    return _run_plans(tables, plans)
+
+async def answer_from_tables_async(docs: list[dict], question: str) -> str:
+    """Version async de answer_from_tables (pandas dans un thread)."""
+    tables = _candidate_tables(docs, question)
+    if not tables:
+        return ""
+    try:
+        plans = await table_query_plans_async(tables, question)
+    except Exception:
+        logger.exception("Planification des tableaux impossible")
+        return ""
+    return await asyncio.to_thread(_run_plans, tables, plans)
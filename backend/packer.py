@@ -0,0 +1,55 @@
+"""
+Remplissage du prompt par priorité, dans un budget de jetons
+────────────────────────────────────────────────────────────
+Chaque morceau candidat (règle système, tour de conversation, passage RAG,
+résumé…) arrive avec son coût en jetons, dans l’ordre de priorité :
+
+• required=True : toujours gardé (règles, question) – le budget peut alors
+  être dépassé, le rapport l’indique (`over`)
+• les autres sont pris tant qu’ils tiennent ; un morceau trop gros est
+  sauté et les suivants, plus petits, peuvent encore entrer
+• chain : morceaux contigus (tours du plus récent au plus ancien) – dès
+  qu’un ne tient plus, les suivants de la même chaîne sont abandonnés
+  (pas de trou dans l’historique)
+
+Rapport : budget, jetons utilisés, morceaux / jetons abandonnés par section.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Any, Dict, List, Tuple
+
+@dataclass
+class Piece:
+    section: str
+    tokens:  int
+    value:   Any = None
+    required: bool = False
+    chain:   str | None = None
+
+def pack(pieces: List[Piece], budget: int) -> Tuple[List[Piece], Dict[str, object]]:
+    """(morceaux gardés – ordre d’entrée conservé –, rapport)."""
+    used   = sum(p.tokens for p in pieces if p.required)
+    kept: List[Piece] = []
+    broken: set[str] = set()
+    dropped: Dict[str, Dict[str, int]] = {}
+
+    for p in pieces:
+        fits = p.required or (p.chain not in broken and used + p.tokens <= budget)
+        if fits:
+            if not p.required:
+                used += p.tokens
+            kept.append(p)
+            continue
+        if p.chain:
+            broken.add(p.chain)
+        d = dropped.setdefault(p.section, {"count": 0, "tokens": 0})
+        d["count"]  += 1
+        d["tokens"] += p.tokens
+
+    return kept, {"budget": budget, "used": used, "over": used > budget, "dropped": dropped}
+
+def drop_report(report: Dict[str, object]) -> str:
+    """Résumé compact pour un en-tête HTTP : « passages:2,older:14 »."""
+    return ",".join(f"{s}:{d['count']}" for s, d in report["dropped"].items())
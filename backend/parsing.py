@@ -0,0 +1,121 @@
+"""
+Parsing des fichiers uploadés – hors de la boucle asyncio
+─────────────────────────────────────────────────────────
+• tout le parsing tourne dans un pool de PROCESSUS (PARSE_WORKERS) :
+  PyPDF2 / pandas / docx2txt sont du pur CPU et tiennent le GIL
+• les PDF sont découpés en lots de PDF_BATCH_PAGES pages extraits en
+  parallèle ; `iter_pdf_pages` les rend dans l’ordre, au fil de l’eau
+• le fichier est écrit UNE fois sur disque : les workers reçoivent un
+  chemin, pas une copie des octets par lot
+
+Module volontairement léger (aucun import backend.*) : il est importé
+par chaque process du pool.
+"""
+
+from __future__ import annotations
+
+import io, os, asyncio, tempfile, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import AsyncIterator, Callable, Dict
+
+import pandas as pd
+import docx2txt
+from PyPDF2 import PdfReader
+
+PARSER_VERSION  = "2"       # ⇐ à incrémenter si un parseur change (clé du cache documents)
+PARSE_WORKERS   = int(os.getenv("PARSE_WORKERS", str(min(4, os.cpu_count() or 1))))
+PDF_BATCH_PAGES = int(os.getenv("PDF_BATCH_PAGES", "16"))
+
+# ---------------------------------------------------------------------------
+#  PARSEURS (synchrones – exécutés dans le pool) ----------------------------
+# ---------------------------------------------------------------------------
+
+def parse_pdf(file_bytes: bytes) -> str:
+    pdf_reader = PdfReader(io.BytesIO(file_bytes))
+    return "\n".join(page.extract_text() or "" for page in pdf_reader.pages)
+
+def parse_docx(file_bytes: bytes) -> str:
+    return docx2txt.process(io.BytesIO(file_bytes))
+
+def parse_txt(file_bytes: bytes) -> str:
+    return file_bytes.decode("utf-8", errors="ignore")
+
+def parse_excel(file_bytes: bytes) -> str:
+    file_obj = io.BytesIO(file_bytes)
+    try:
+        df = pd.read_excel(file_obj)
+    except Exception:
+        file_obj.seek(0)
+        df = pd.read_csv(file_obj)
+    return df.to_csv(index=False)
+
+def _pdf_page_count(path: str) -> int:
+    return len(PdfReader(path).pages)
+
+def _pdf_pages(path: str, start: int, stop: int) -> str:
+    pages = PdfReader(path).pages
+    return "\n".join(pages[i].extract_text() or "" for i in range(start, stop))
+
+# ---------------------------------------------------------------------------
+#  POOL ----------------------------------------------------------------------
+# ---------------------------------------------------------------------------
+_pool: ProcessPoolExecutor | None = None
+
+def _get_pool() -> ProcessPoolExecutor:
+    # « spawn » : pas de fork d’un process qui a des threads (uvicorn, pools…)
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=max(1, PARSE_WORKERS),
+                                    mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+async def run_in_pool(fn: Callable, *args):
+    return await asyncio.get_running_loop().run_in_executor(_get_pool(), fn, *args)
+
+# ---------------------------------------------------------------------------
+#  API async -----------------------------------------------------------------
+# ---------------------------------------------------------------------------
+
+async def iter_pdf_pages(file_bytes: bytes) -> AsyncIterator[str]:
+    """
+    Texte du PDF par lots de pages, dans l’ordre ; les lots sont extraits
+    en parallèle et rendus dès que le lot suivant attendu est prêt.
+    """
+    fd, path = tempfile.mkstemp(suffix=".pdf")
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(file_bytes)
+        n = await run_in_pool(_pdf_page_count, path)
+        loop = asyncio.get_running_loop()
+        futs = [
+            loop.run_in_executor(_get_pool(), _pdf_pages, path, s, min(s + PDF_BATCH_PAGES, n))
+            for s in range(0, n, PDF_BATCH_PAGES)
+        ]
+        try:
+            for fut in futs:
+                yield await fut
+        finally:
+            for fut in futs:
+                fut.cancel()
+            await asyncio.gather(*futs, return_exceptions=True)   # avant de supprimer le fichier
+    finally:
+        os.unlink(path)
+
+async def parse_pdf_async(file_bytes: bytes) -> str:
+    return "\n".join([batch async for batch in iter_pdf_pages(file_bytes)])
+
+_PARSERS: Dict[str, Callable[[bytes], str]] = {
+    ".docx": parse_docx,
+    ".txt":  parse_txt,
+    ".csv":  parse_excel,
+}
+
+async def parse_document(name: str, file_bytes: bytes) -> str:
+    """Texte brut d’un fichier uploadé ("" si extension non gérée)."""
+    low = name.lower()
+    if low.endswith(".pdf"):
+        return await parse_pdf_async(file_bytes)
+    for ext, fn in _PARSERS.items():
+        if low.endswith(ext):
+            return await run_in_pool(fn, file_bytes)
+    return ""
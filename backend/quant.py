@@ -0,0 +1,57 @@
+"""
+Stockage compact des vecteurs – quantification scalaire int8
+────────────────────────────────────────────────────────────
+• codes.npy   int8  (n × dim)  : v / scale, arrondi dans [-127, 127]
+• scales.npy  float32 (n,)     : max|v| / 127, un facteur par vecteur
+
+Les deux fichiers sont ouverts en mmap : les pages sont partagées entre
+workers uvicorn (cache disque de l’OS) et 4× plus petites que float32.
+La recherche balaie les codes int8 par blocs, puis re-classe les meilleurs
+candidats en float32 exact (vectors.npy, lui aussi en mmap : seules les
+lignes candidates sont lues).
+"""
+
+from __future__ import annotations
+
+from typing import Tuple
+
+import numpy as np
+
+BLOCK         = 2_048      # lignes converties en float à la fois (mémoire temporaire bornée)
+RERANK_FACTOR = 8          # candidats int8 = k × RERANK_FACTOR
+
+def quantize(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """float32 (n × dim) → (codes int8, scales float32)."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    scales  = np.abs(vectors).max(axis=1) / 127.0
+    scales  = np.maximum(scales, 1e-12).astype(np.float32)
+    codes   = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales
+
+def approx_scores(codes: np.ndarray, scales: np.ndarray, q: np.ndarray) -> np.ndarray:
+    """Produits scalaires approchés, calculés bloc par bloc."""
+    out = np.empty(len(codes), dtype=np.float32)
+    for start in range(0, len(codes), BLOCK):
+        block = np.asarray(codes[start:start + BLOCK], dtype=np.float32)
+        out[start:start + BLOCK] = (block @ q) * scales[start:start + BLOCK]
+    return out
+
+def search(vectors: np.ndarray, codes: np.ndarray, scales: np.ndarray,
+           q: np.ndarray, k: int, rerank: int = RERANK_FACTOR) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Top-k (indices, similarités exactes) : balayage int8 puis re-classement float.
+    Petits index (n ≤ k × rerank) : calcul exact direct.
+    """
+    n = len(codes)
+    if n == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    n_cand = min(n, max(k, k * rerank))
+    if n_cand == n:
+        cand = np.arange(n)
+    else:
+        approx = approx_scores(codes, scales, q)
+        cand   = np.sort(np.argpartition(-approx, n_cand - 1)[:n_cand])   # lecture mmap ordonnée
+
+    exact = np.asarray(vectors[cand], dtype=np.float32) @ q
+    top   = np.argsort(-exact)[:k]
+    return cand[top], exact[top]
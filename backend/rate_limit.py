@@ -1,67 +1,332 @@
 """
-Rate-limit « intelligent » par *famille* de modèle Azure OpenAI
-───────────────────────────────────────────────────────────────
+Rate-limit par *déploiement* Azure OpenAI – seau à jetons, RPM + TPM
+────────────────────────────────────────────────────────────────────
 ─ RPM = requêtes par minute
 ─ TPM = jetons (par minute, entrée + sortie)
 
-Le bucket se recharge toutes les 60 s.  Si un appel ferait
-déborder la limite on dort exactement le temps restant avant
-le prochain reset, puis on consomme.
+Deux seaux par déploiement, rechargés EN CONTINU (rpm/60 et tpm/60 par
+seconde, plafonnés à la limite minute) – pas de reset brutal à 60 s.
+
+• acquire(n)    : réserve 1 requête + n jetons estimés (prompt + max_tokens),
+                  attend (en re-vérifiant) tant que l’un des seaux est vide
+• reconcile(..) : ajuste la réservation sur l’`usage` réel de la réponse
+                  (rembourse le trop-perçu, ou crée une dette)
+• capacity()    : capacité restante (lecture seule), exposée par /quota
+                  et utilisée par le routeur
+
+Une réservation plus grosse que le TPM passe dès que le seau est plein
+(le solde devient négatif : les appels suivants attendent la recharge).
+
+Où vivent les seaux (RATE_LIMIT_BACKEND) :
+  local  : mémoire du process (défaut – un seul worker)
+  sqlite : fichier partagé par les workers d’un même hôte
+           (RATE_LIMIT_SQLITE_PATH, transaction BEGIN IMMEDIATE)
+  redis  : serveur Redis partagé par toutes les instances
+           (RATE_LIMIT_REDIS_URL, script Lua atomique, horloge du serveur)
+Backend injoignable → seaux locaux pendant RATE_LIMIT_RETRY_S, puis
+nouvel essai (un worker isolé reste borné par ses propres seaux).
+Côté async, les opérations sur un backend partagé (E/S sqlite / redis)
+passent par asyncio.to_thread : la boucle n’attend jamais le backend.
+
+Priorités (scheduler.py) : acquire() laisse dans le seau la part réservée
+aux classes plus prioritaires (`floor`, réduite à mesure que l’appel attend).
 """
 
 from __future__ import annotations
-import time, threading
-
-# ──────────────────────────── quotas par famille
-_FAMILIES = {
-    "4o":       dict(rpm=48,    tpm=8_000),
-    "4o-mini":  dict(rpm=2_500, tpm=250_000),
-    "o1":       dict(rpm=100,   tpm=600_000),
-    "o1-mini":  dict(rpm=100,   tpm=1_000_000),
-    "o3-mini":  dict(rpm=90,    tpm=90_000),     # file d’attente 90 k jetons
-    "4.1-mini": dict(rpm=150,   tpm=150_000),
-    "4.1":      dict(rpm=150,   tpm=150_000),
-}
-
-# ──────────────────────────── bucket interne
-class _Bucket:
-    def __init__(self, rpm: int, tpm: int):
-        self.rpm, self.tpm = rpm, tpm
-        self.lock = threading.Lock()
-        self._reset()
-
-    def _reset(self) -> None:
-        self.start   = time.time()
-        self.reqs    = 0
-        self.tokens  = 0
-
-    def charge(self, n_tokens: int) -> None:
-        with self.lock:
-            now = time.time()
-            elapsed = now - self.start
-
-            # reset chaque minute glissante
-            if elapsed >= 60:
-                self._reset()
-
-            # faut-il attendre ?
-            will_reqs   = self.reqs   + 1
-            will_tokens = self.tokens + n_tokens
-            if will_reqs > self.rpm or will_tokens > self.tpm:
-                sleep_for = 60 - elapsed
-                time.sleep(max(0.0, sleep_for))
-                self._reset()                       # minute suivante
-
-            # on consomme
-            self.reqs   += 1
-            self.tokens += n_tokens
-
-# ──────────────────────────── buckets par famille
-_BUCKETS = {fam: _Bucket(**q) for fam, q in _FAMILIES.items()}
-
-def charge(family: str, n_tokens: int) -> None:
+import os, time, asyncio, hashlib, logging, sqlite3, threading
+from pathlib import Path
+from typing import Dict, Tuple
+
+from backend.cache import CACHE_DIR
+from backend.scheduler import scheduler, current_priority, reserve
+
+try:                                    # optionnel : backend redis uniquement
+    import redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_BACKEND     = os.getenv("RATE_LIMIT_BACKEND", "local").lower()
+RATE_LIMIT_SQLITE_PATH = Path(os.getenv("RATE_LIMIT_SQLITE_PATH", CACHE_DIR / "rate_limit.sqlite"))
+RATE_LIMIT_REDIS_URL   = os.getenv("RATE_LIMIT_REDIS_URL", "redis://localhost:6379/0")
+RATE_LIMIT_RETRY_S     = float(os.getenv("RATE_LIMIT_RETRY_S", "30"))
+
+Bucket = Tuple[float, float, float]     # (requêtes, jetons, attente s)
+
+# ──────────────────────────── arithmétique du seau (local / sqlite)
+def _apply(reqs: float, tokens: float, dt: float, rpm: int, tpm: int,
+           op: str, n: float, floor: float = 0.0) -> Bucket:
     """
-    Bloque évent. jusqu’à ce qu’il soit légal d’envoyer.
-    Lève KeyError si la famille n’est pas déclarée (débogage).
+    Recharge sur `dt` s puis applique `op` : take | adjust | peek (recharge seule).
+    take : laisse au moins `floor` × capacité dans chaque seau.
     """
-    _BUCKETS[family].charge(n_tokens)
+    reqs   = min(rpm, reqs   + max(0.0, dt) * rpm / 60)
+    tokens = min(tpm, tokens + max(0.0, dt) * tpm / 60)
+    if op == "take":
+        need_r = min(rpm, 1 + floor * rpm)
+        need_t = min(tpm, min(n, tpm) + floor * tpm)
+        if reqs >= need_r and tokens >= need_t:
+            return reqs - 1, tokens - n, 0.0
+        wait_r = (need_r - reqs) * 60 / rpm if reqs < need_r else 0.0
+        wait_t = (need_t - tokens) * 60 / tpm if tokens < need_t else 0.0
+        return reqs, tokens, max(wait_r, wait_t) + 0.01
+    if op == "adjust":
+        tokens = min(tpm, tokens + n)
+    return reqs, tokens, 0.0
+
+# ──────────────────────────── backends
+class LocalStore:
+    name = "local"
+
+    def __init__(self):
+        self._lock  = threading.Lock()
+        self._state: Dict[str, Tuple[float, float, float]] = {}
+
+    def op(self, key: str, rpm: int, tpm: int, op: str, n: float = 0,
+           floor: float = 0.0) -> Bucket:
+        with self._lock:
+            now = time.monotonic()
+            reqs, tokens, updated = self._state.get(key, (rpm, tpm, now))
+            reqs, tokens, wait = _apply(reqs, tokens, now - updated, rpm, tpm, op, n, floor)
+            self._state[key] = (reqs, tokens, now)
+            return reqs, tokens, wait
+
+    def peek(self, key: str, rpm: int, tpm: int) -> Bucket:
+        with self._lock:
+            now = time.monotonic()
+            reqs, tokens, updated = self._state.get(key, (rpm, tpm, now))
+        return _apply(reqs, tokens, now - updated, rpm, tpm, "peek", 0)
+
+class SQLiteStore:
+    name = "sqlite"
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db   = sqlite3.connect(str(path), timeout=5, isolation_level=None,
+                                     check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS buckets "
+                         "(key TEXT PRIMARY KEY, reqs REAL, tokens REAL, updated REAL)")
+
+    def op(self, key: str, rpm: int, tpm: int, op: str, n: float = 0,
+           floor: float = 0.0) -> Bucket:
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")          # verrou d’écriture inter-process
+            try:
+                now = time.time()                        # horloge commune aux workers
+                row = self._db.execute("SELECT reqs, tokens, updated FROM buckets "
+                                       "WHERE key = ?", (key,)).fetchone()
+                reqs, tokens, updated = row or (rpm, tpm, now)
+                reqs, tokens, wait = _apply(reqs, tokens, now - updated, rpm, tpm, op, n, floor)
+                self._db.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?)",
+                                 (key, reqs, tokens, now))
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            return reqs, tokens, wait
+
+    def peek(self, key: str, rpm: int, tpm: int) -> Bucket:
+        """Simple SELECT (WAL : ne bloque ni n’attend les écrivains)."""
+        with self._lock:
+            row = self._db.execute("SELECT reqs, tokens, updated FROM buckets "
+                                   "WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        reqs, tokens, updated = row or (rpm, tpm, now)
+        return _apply(reqs, tokens, now - updated, rpm, tpm, "peek", 0)
+
+# même arithmétique que _apply, exécutée atomiquement par le serveur
+_LUA = """
+local rpm, tpm, op, n = tonumber(ARGV[1]), tonumber(ARGV[2]), ARGV[3], tonumber(ARGV[4])
+local floor = tonumber(ARGV[5]) or 0
+local tm  = redis.call('TIME')
+local now = tonumber(tm[1]) + tonumber(tm[2]) / 1000000
+local s   = redis.call('HMGET', KEYS[1], 'r', 't', 'u')
+local r, t, u = tonumber(s[1]) or rpm, tonumber(s[2]) or tpm, tonumber(s[3]) or now
+local dt  = math.max(0, now - u)
+r = math.min(rpm, r + dt * rpm / 60)
+t = math.min(tpm, t + dt * tpm / 60)
+local wait = 0
+if op == 'take' then
+  local need_r = math.min(rpm, 1 + floor * rpm)
+  local need_t = math.min(tpm, math.min(n, tpm) + floor * tpm)
+  if r >= need_r and t >= need_t then
+    r = r - 1
+    t = t - n
+  else
+    local wr, wt = 0, 0
+    if r < need_r then wr = (need_r - r) * 60 / rpm end
+    if t < need_t then wt = (need_t - t) * 60 / tpm end
+    wait = math.max(wr, wt) + 0.01
+  end
+elseif op == 'adjust' then
+  t = math.min(tpm, t + n)
+end
+redis.call('HSET', KEYS[1], 'r', r, 't', t, 'u', now)
+redis.call('EXPIRE', KEYS[1], 120)
+return {tostring(r), tostring(t), tostring(wait)}
+"""
+
+class RedisStore:
+    name = "redis"
+
+    def __init__(self, url: str):
+        if redis is None:
+            raise RuntimeError("RATE_LIMIT_BACKEND=redis mais le paquet « redis » est absent")
+        self._client = redis.Redis.from_url(url, socket_timeout=0.5,
+                                            socket_connect_timeout=0.5)
+        self._script = self._client.register_script(_LUA)
+
+    def op(self, key: str, rpm: int, tpm: int, op: str, n: float = 0,
+           floor: float = 0.0) -> Bucket:
+        r, t, wait = self._script(keys=[f"klint:rl:{key}"], args=[rpm, tpm, op, n, floor])
+        return float(r), float(t), float(wait)
+
+    def peek(self, key: str, rpm: int, tpm: int) -> Bucket:
+        """TIME + HMGET en un aller-retour, recharge calculée ici (aucune écriture)."""
+        pipe = self._client.pipeline(transaction=False)
+        pipe.time()
+        pipe.hmget(f"klint:rl:{key}", "r", "t", "u")
+        (sec, usec), (r, t, u) = pipe.execute()
+        now = sec + usec / 1_000_000
+        reqs, tokens = float(r) if r is not None else rpm, float(t) if t is not None else tpm
+        updated = float(u) if u is not None else now
+        return _apply(reqs, tokens, now - updated, rpm, tpm, "peek", 0)
+
+class _Store:
+    """Backend partagé configuré, avec repli sur les seaux locaux."""
+
+    def __init__(self, backend: str):
+        self.local  = LocalStore()
+        self.shared = None
+        self.down_until = 0.0
+        try:
+            if backend == "sqlite":
+                self.shared = SQLiteStore(RATE_LIMIT_SQLITE_PATH)
+            elif backend == "redis":
+                self.shared = RedisStore(RATE_LIMIT_REDIS_URL)
+        except Exception as exc:
+            logger.warning("Rate-limit %s indisponible (%s) : seaux locaux", backend, exc)
+
+    @property
+    def name(self) -> str:
+        if self.shared is None:
+            return "local"
+        if time.monotonic() < self.down_until:
+            return f"local (repli {self.shared.name})"
+        return self.shared.name
+
+    @property
+    def blocking(self) -> bool:
+        """Vrai si les opérations font des E/S (backend partagé joignable)."""
+        return self.shared is not None and time.monotonic() >= self.down_until
+
+    def _call(self, method: str, *args) -> Bucket:
+        if self.blocking:
+            try:
+                return getattr(self.shared, method)(*args)
+            except Exception as exc:
+                self.down_until = time.monotonic() + RATE_LIMIT_RETRY_S
+                logger.warning("Rate-limit %s injoignable (%s) : seaux locaux %.0f s",
+                               self.shared.name, exc, RATE_LIMIT_RETRY_S)
+        return getattr(self.local, method)(*args)
+
+    def op(self, key: str, rpm: int, tpm: int, op: str, n: float = 0,
+           floor: float = 0.0) -> Bucket:
+        return self._call("op", key, rpm, tpm, op, n, floor)
+
+    def peek(self, key: str, rpm: int, tpm: int) -> Bucket:
+        return self._call("peek", key, rpm, tpm)
+
+_store = _Store(RATE_LIMIT_BACKEND)
+
+# ──────────────────────────── limiteur d’un déploiement
+class Limiter:
+    def __init__(self, name: str, rpm: int, tpm: int, key: str | None = None):
+        self.name, self.rpm, self.tpm = name, rpm, tpm
+        self.key    = key or name               # clé des seaux dans le backend
+        self.waited = 0.0                       # s cumulées d’attente (métrique, par worker)
+
+    def try_acquire(self, n_tokens: int, floor: float = 0.0) -> float:
+        """Réserve et renvoie 0, ou renvoie l’attente (s) avant de pouvoir réserver."""
+        return _store.op(self.key, self.rpm, self.tpm, "take", n_tokens, floor)[2]
+
+    def _attempt(self, n_tokens: int, cls: str, t0: float) -> float:
+        """Attente avant le prochain essai (0 = réservé) ; recontrôle ≤ 1 s tant que la réserve vieillit."""
+        floor = reserve(cls, time.monotonic() - t0)
+        delay = self.try_acquire(n_tokens, floor)
+        return min(delay, 1.0) if delay and floor else delay
+
+    async def _attempt_async(self, n_tokens: int, cls: str, t0: float) -> float:
+        if _store.blocking:                     # sqlite / redis : hors de la boucle
+            return await asyncio.to_thread(self._attempt, n_tokens, cls, t0)
+        return self._attempt(n_tokens, cls, t0)
+
+    def acquire(self, n_tokens: int, cls: str | None = None) -> int:
+        """Bloque jusqu’à la réservation ; renvoie les jetons réservés."""
+        cls = cls or current_priority()
+        t0, ok = scheduler.enter(cls), False
+        try:
+            while True:
+                delay = self._attempt(n_tokens, cls, t0)
+                if not delay:
+                    ok = True
+                    return n_tokens
+                self.waited += delay
+                time.sleep(delay)
+        finally:
+            scheduler.leave(cls, t0, ok)
+
+    async def acquire_async(self, n_tokens: int, cls: str | None = None) -> int:
+        cls = cls or current_priority()
+        t0, ok = scheduler.enter(cls), False
+        try:
+            while True:
+                delay = await self._attempt_async(n_tokens, cls, t0)
+                if not delay:
+                    ok = True
+                    return n_tokens
+                self.waited += delay
+                await asyncio.sleep(delay)
+        finally:
+            scheduler.leave(cls, t0, ok)
+
+    def reconcile(self, reserved: int, actual: int) -> None:
+        """Remplace la réservation par la consommation réelle (0 si l’appel a échoué)."""
+        if reserved != actual:
+            _store.op(self.key, self.rpm, self.tpm, "adjust", reserved - actual)
+
+    async def reconcile_async(self, reserved: int, actual: int) -> None:
+        if reserved != actual and _store.blocking:
+            await asyncio.to_thread(self.reconcile, reserved, actual)
+        else:
+            self.reconcile(reserved, actual)
+
+    def capacity(self) -> Dict[str, float]:
+        """Lecture seule : aucune écriture ni verrou d’écriture côté backend."""
+        reqs, tokens, _ = _store.peek(self.key, self.rpm, self.tpm)
+        return {
+            "rpm": self.rpm, "tpm": self.tpm,
+            "rpm_remaining": int(reqs),
+            "tpm_remaining": int(tokens),       # < 0 = dette en cours
+            "waited_s": round(self.waited, 2),
+            "backend": _store.name,
+        }
+
+# ──────────────────────────── registre (clé = endpoint du déploiement)
+_lock = threading.Lock()
+_LIMITERS: Dict[str, Limiter] = {}
+
+def limiter(key: str, rpm: int, tpm: int, name: str | None = None) -> Limiter:
+    with _lock:
+        lim = _LIMITERS.get(key)
+        if lim is None:
+            shared = hashlib.sha1(key.encode()).hexdigest()[:16]     # pas d’URL dans le backend
+            lim = _LIMITERS[key] = Limiter(name or key, rpm, tpm, key=shared)
+        return lim
+
+def get_limiter(key: str) -> Limiter | None:
+    with _lock:
+        return _LIMITERS.get(key)
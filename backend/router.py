@@ -0,0 +1,129 @@
+"""
+Routage entre les déploiements d’une même famille
+─────────────────────────────────────────────────
+Chaque appel choisit le déploiement au score le plus bas :
+
+    score = (en cours + 1) × latence EWMA × (1 + 4 × taux d’erreur EWMA)
+            ─────────────────────────────────────────────────────────────
+                  marge RPM/TPM restante (limiteur, cf. rate_limit.py)
+
+• marge lue hors verrou et gardée ROUTER_HEADROOM_TTL_S (lecture du
+  backend de rate-limit au plus une fois par fenêtre et par déploiement)
+• un déploiement jamais mesuré prend la meilleure latence connue
+  (il est essayé tôt) ; égalités départagées au hasard
+• 429 / 5xx / erreur réseau → refroidissement Retry-After (ou backoff) ;
+  ROUTER_MAX_FAILS échecs d’affilée → refroidissement ROUTER_COOLDOWN_S
+• si tous refroidissent : le premier disponible + l’attente à respecter
+"""
+
+from __future__ import annotations
+
+import os, time, random, threading
+from typing import Dict, Iterable, Tuple
+
+from backend.rate_limit import get_limiter
+
+ROUTER_ALPHA      = float(os.getenv("ROUTER_EWMA_ALPHA", "0.2"))
+ROUTER_COOLDOWN_S = float(os.getenv("ROUTER_COOLDOWN_S", "30"))
+ROUTER_MAX_FAILS  = int(os.getenv("ROUTER_MAX_FAILS", "3"))
+ROUTER_HEADROOM_TTL_S = float(os.getenv("ROUTER_HEADROOM_TTL_S", "0.1"))
+
+class _Health:
+    __slots__ = ("inflight", "latency", "errors", "fails", "cool_until", "calls")
+
+    def __init__(self):
+        self.inflight   = 0
+        self.latency    = None      # s, EWMA des appels réussis
+        self.errors     = 0.0       # EWMA de 0 / 1
+        self.fails      = 0         # échecs consécutifs
+        self.cool_until = 0.0
+        self.calls      = 0
+
+class Router:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._h: Dict[str, _Health] = {}
+        self._room: Dict[str, Tuple[float, float]] = {}     # ep → (marge, expiration)
+
+    def _get(self, ep: str) -> _Health:
+        h = self._h.get(ep)
+        if h is None:
+            h = self._h[ep] = _Health()
+        return h
+
+    def _headroom(self, ep: str, now: float) -> float:
+        """Marge RPM/TPM (0.02 – 1) ; appelée hors de self._lock (E/S possibles)."""
+        hit = self._room.get(ep)
+        if hit is not None and hit[1] > now:
+            return hit[0]
+        lim  = get_limiter(ep)
+        room = 1.0
+        if lim is not None:
+            c    = lim.capacity()
+            room = max(0.02, min(c["rpm_remaining"] / c["rpm"],
+                                 max(0, c["tpm_remaining"]) / c["tpm"]))
+        self._room[ep] = (room, now + ROUTER_HEADROOM_TTL_S)
+        return room
+
+    def choose(self, endpoints: Iterable[str]) -> Tuple[str, float]:
+        """(endpoint, attente en s avant de l’utiliser – 0 s’il est disponible)."""
+        eps = list(endpoints)
+        now  = time.monotonic()
+        room = {ep: self._headroom(ep, now) for ep in eps}
+        with self._lock:
+            hs    = {ep: self._get(ep) for ep in eps}
+            ready = [ep for ep in eps if hs[ep].cool_until <= now]
+            if not ready:
+                ep = min(eps, key=lambda e: hs[e].cool_until)
+                return ep, hs[ep].cool_until - now
+            known = [h.latency for h in hs.values() if h.latency is not None]
+            default_lat = min(known) if known else 1.0
+
+            def score(ep: str) -> Tuple[float, float]:
+                h   = hs[ep]
+                lat = h.latency if h.latency is not None else default_lat
+                return ((h.inflight + 1) * lat * (1 + 4 * h.errors) / room[ep],
+                        random.random())
+            return min(ready, key=score), 0.0
+
+    def begin(self, ep: str) -> None:
+        with self._lock:
+            h = self._get(ep)
+            h.inflight += 1
+            h.calls    += 1
+
+    def release(self, ep: str) -> None:
+        with self._lock:
+            h = self._get(ep)
+            h.inflight = max(0, h.inflight - 1)
+
+    def observe(self, ep: str, latency: float, ok: bool,
+                cooldown: float | None = None) -> None:
+        """Résultat d’un appel ; `cooldown` (s) : pause imposée (429 Retry-After…)."""
+        with self._lock:
+            h = self._get(ep)
+            h.errors = (1 - ROUTER_ALPHA) * h.errors + ROUTER_ALPHA * (0.0 if ok else 1.0)
+            if ok:
+                h.fails   = 0
+                h.latency = latency if h.latency is None else \
+                            (1 - ROUTER_ALPHA) * h.latency + ROUTER_ALPHA * latency
+                return
+            h.fails += 1
+            if h.fails >= ROUTER_MAX_FAILS:
+                cooldown = max(cooldown or 0.0, ROUTER_COOLDOWN_S)
+            if cooldown:
+                h.cool_until = max(h.cool_until, time.monotonic() + cooldown)
+
+    def health(self, ep: str) -> Dict[str, object]:
+        now = time.monotonic()
+        with self._lock:
+            h = self._get(ep)
+            return {
+                "inflight":   h.inflight,
+                "calls":      h.calls,
+                "latency_s":  round(h.latency, 3) if h.latency is not None else None,
+                "error_rate": round(h.errors, 3),
+                "cooldown_s": round(max(0.0, h.cool_until - now), 1),
+            }
+
+router = Router()
@@ -0,0 +1,108 @@
+"""
+Classes de priorité des appels LLM – devant les seaux RPM / TPM
+───────────────────────────────────────────────────────────────
+Chat en direct, résumés d’upload, résumés de conversation et OCR puisent
+dans les mêmes seaux de déploiement (rate_limit.py). Chaque appel porte
+une classe :
+
+  interactive-stream : flux de chat (défaut des *_stream)
+  interactive-sync   : appels sync du tour de chat (défaut)
+  background         : ingestion, résumés, embeddings de documents
+
+Part réservée : une classe ne prend dans un seau que s’il reste, après
+elle, PRIORITY_RESERVE_<CLASSE> × capacité (0 pour les flux). Le fond peut
+donc consommer tout le débit de recharge quand le chat est calme, mais
+une rafale interactive trouve toujours cette réserve disponible.
+
+Vieillissement : la réserve exigée décroît linéairement avec l’attente et
+s’annule après PRIORITY_AGING_S – aucune classe n’attend indéfiniment.
+
+Classe courante : `with priority("background"): …` (ContextVar, suivie par
+asyncio.to_thread ; `bind(fn)` pour les pools de threads) ou `cls=` explicite.
+Métriques par classe : file d’attente, admissions, attente moyenne / max.
+"""
+
+from __future__ import annotations
+
+import os, time, threading, contextvars
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional
+
+PRIORITY_AGING_S = float(os.getenv("PRIORITY_AGING_S", "30"))
+RESERVES: Dict[str, float] = {
+    "interactive-stream": 0.0,
+    "interactive-sync":   float(os.getenv("PRIORITY_RESERVE_SYNC", "0.1")),
+    "background":         float(os.getenv("PRIORITY_RESERVE_BACKGROUND", "0.5")),
+}
+DEFAULT_CLASS = "interactive-sync"
+
+_current: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("llm_priority", default=None)
+
+@contextmanager
+def priority(cls: str) -> Iterator[None]:
+    if cls not in RESERVES:
+        raise ValueError(f"classe de priorité inconnue : {cls!r}")
+    token = _current.set(cls)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+def current_priority(default: str = DEFAULT_CLASS) -> str:
+    return _current.get() or default
+
+def bind(fn: Callable) -> Callable:
+    """fn exécutée avec la classe courante (pour pool.submit / pool.map)."""
+    ctx = contextvars.copy_context()
+    return lambda *a, **kw: ctx.copy().run(fn, *a, **kw)
+
+def reserve(cls: str, waited: float) -> float:
+    """Part du seau à laisser aux autres après `waited` s d’attente (vieillissement)."""
+    base = RESERVES[cls]
+    if not base or PRIORITY_AGING_S <= 0:
+        return 0.0
+    return base * max(0.0, 1.0 - waited / PRIORITY_AGING_S)
+
+class _ClassStats:
+    __slots__ = ("depth", "max_depth", "admitted", "wait_total", "wait_max")
+
+    def __init__(self):
+        self.depth = self.max_depth = self.admitted = 0
+        self.wait_total = self.wait_max = 0.0
+
+class Scheduler:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._s: Dict[str, _ClassStats] = {c: _ClassStats() for c in RESERVES}
+
+    def enter(self, cls: str) -> float:
+        with self._lock:
+            s = self._s[cls]
+            s.depth    += 1
+            s.max_depth = max(s.max_depth, s.depth)
+        return time.monotonic()
+
+    def leave(self, cls: str, t0: float, admitted: bool) -> None:
+        waited = time.monotonic() - t0
+        with self._lock:
+            s = self._s[cls]
+            s.depth -= 1
+            if admitted:
+                s.admitted   += 1
+                s.wait_total += waited
+                s.wait_max    = max(s.wait_max, waited)
+
+    def stats(self) -> Dict[str, Dict[str, object]]:
+        with self._lock:
+            return {
+                cls: {
+                    "reserve": RESERVES[cls],
+                    "queued": s.depth, "max_queued": s.max_depth,
+                    "admitted": s.admitted,
+                    "wait_avg_s": round(s.wait_total / s.admitted, 3) if s.admitted else None,
+                    "wait_max_s": round(s.wait_max, 3),
+                }
+                for cls, s in self._s.items()
+            }
+
+scheduler = Scheduler()
@@ -0,0 +1,127 @@
+"""
+Single-flight – un seul appel en vol par requête identique
+──────────────────────────────────────────────────────────
+Double envoi, ou plusieurs utilisateurs qui ouvrent le même fichier :
+les appels LLM / embeddings de contenu identique (même empreinte) partent
+une seule fois ; les suivants attendent le résultat – ou l’exception – du
+premier (« meneur ») au lieu de consommer RPM / TPM.
+
+• sync  : do(key, fn, *args)        – le meneur exécute fn dans son thread
+• async : do_async(key, factory)    – le meneur est une tâche partagée ;
+  un appelant annulé se retire sans annuler les autres, la tâche n’est
+  annulée que si plus personne ne l’attend
+• sync et async partagent les vols (un appel async peut suivre un sync)
+• rien n’est retenu une fois le vol terminé (≠ cache de réponses)
+• métriques : appels, meneurs, appels fusionnés, échecs, abandons
+"""
+
+from __future__ import annotations
+
+import asyncio, threading
+import concurrent.futures as cf
+from typing import Any, Awaitable, Callable, Dict
+
+FLIGHTS: Dict[str, "SingleFlight"] = {}         # nom → groupe (exposé par /singleflight/stats)
+
+class _Flight:
+    __slots__ = ("future", "task", "waiters")
+
+    def __init__(self):
+        self.future  = cf.Future()              # résultat partagé (thread-safe)
+        self.task    = None                     # meneur async
+        self.waiters = 0
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._flights: Dict[str, _Flight] = {}
+        self.calls = self.leaders = self.coalesced = self.failed = self.abandoned = 0
+        FLIGHTS[name] = self
+
+    def _join(self, key: str) -> tuple[_Flight, bool]:
+        with self._lock:
+            self.calls += 1
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+            flight.waiters += 1
+            return flight, leader
+
+    def _settle(self, key: str, flight: _Flight, result: Any = None,
+                exc: BaseException | None = None, cancelled: bool = False) -> None:
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            if exc is not None:
+                self.failed += 1
+        if cancelled:
+            flight.future.cancel()
+        elif exc is not None:
+            flight.future.set_exception(exc)
+        else:
+            flight.future.set_result(result)
+
+    def _settle_task(self, key: str, flight: _Flight, task: asyncio.Future) -> None:
+        if task.cancelled():
+            self._settle(key, flight, cancelled=True)
+        else:
+            self._settle(key, flight, task.result() if task.exception() is None else None,
+                         exc=task.exception())
+
+    def _leave(self, flight: _Flight) -> None:
+        with self._lock:
+            flight.waiters -= 1
+
+    # ─── sync
+    def do(self, key: str, fn: Callable[..., Any], *args: Any) -> Any:
+        flight, leader = self._join(key)
+        try:
+            if not leader:
+                return flight.future.result()
+            try:
+                result = fn(*args)
+            except BaseException as exc:
+                self._settle(key, flight, exc=exc)
+                raise
+            self._settle(key, flight, result)
+            return result
+        finally:
+            self._leave(flight)
+
+    # ─── async
+    async def do_async(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        flight, leader = self._join(key)
+        if leader:
+            flight.task = asyncio.ensure_future(factory())
+            flight.task.add_done_callback(lambda t: self._settle_task(key, flight, t))
+        try:
+            # shield : annuler CET appelant ne doit pas annuler le résultat partagé
+            return await asyncio.shield(asyncio.wrap_future(flight.future))
+        finally:
+            with self._lock:
+                flight.waiters -= 1
+                orphan = (flight.waiters == 0 and flight.task is not None
+                          and not flight.task.done())
+                if orphan:
+                    self.abandoned += 1
+                    if self._flights.get(key) is flight:     # les suivants repartent à neuf
+                        del self._flights[key]
+            if orphan:
+                flight.task.cancel()
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            return {
+                "calls": self.calls, "leaders": self.leaders,
+                "coalesced": self.coalesced, "failed": self.failed,
+                "abandoned": self.abandoned, "in_flight": len(self._flights),
+                "coalesced_rate": round(self.coalesced / self.calls, 3) if self.calls else None,
+            }
+
+def flight_stats() -> Dict[str, Dict[str, object]]:
+    return {name: sf.stats() for name, sf in FLIGHTS.items()}
@@ -0,0 +1,172 @@
+"""
+Tableaux uploadés (CSV / Excel) – stockage colonnaire + requêtes locales
+───────────────────────────────────────────────────────────────────────
+• à l’upload : DataFrame → Parquet sous TABLE_DIR/<sha256>.parquet,
+  + un descriptif compact (schéma, stats, aperçu) qui sert de texte au
+  document (résumé / RAG) à la place du CSV complet
+• au tour de chat : le LLM traduit la question en un PLAN JSON
+  (filtres, group-by, agrégats, tri, limite – cf. models.table_query_plans),
+  exécuté ici avec pandas ; seul le petit résultat va dans le prompt
+
+Module léger (pandas seul) : `store_table` tourne dans le pool de process.
+"""
+
+from __future__ import annotations
+
+import io, os, hashlib, tempfile
+from pathlib import Path
+from typing import List
+
+import pandas as pd
+
+TABLE_DIR       = Path(os.getenv("TABLE_DIR", Path(tempfile.gettempdir()) / "klint_tables"))
+TABLE_EXT       = (".csv", ".xlsx", ".xls")
+TEXT_MAX_ROWS   = 2_000      # en dessous : le CSV complet reste aussi indexé (RAG)
+RESULT_MAX_ROWS = 50
+
+_OPS  = {"==", "!=", ">", ">=", "<", "<=", "contains", "in"}
+_AGGS = {"sum", "mean", "min", "max", "count", "nunique", "median"}
+_CMP  = {"==": "eq", "!=": "ne", ">": "gt", ">=": "ge", "<": "lt", "<=": "le"}
+
+def is_table(name: str) -> bool:
+    return name.lower().endswith(TABLE_EXT)
+
+def _path(key: str) -> Path:
+    return TABLE_DIR / f"{key}.parquet"
+
+# ──────────────────────────── upload
+def _read(file_bytes: bytes) -> pd.DataFrame:
+    file_obj = io.BytesIO(file_bytes)
+    try:
+        df = pd.read_excel(file_obj)
+    except Exception:
+        file_obj.seek(0)
+        df = pd.read_csv(file_obj)
+    df.columns = [str(c) for c in df.columns]
+    for c in df.columns:                             # colonnes mixtes → texte (Parquet)
+        if df[c].dtype == object:
+            df[c] = df[c].astype("string")
+    return df
+
+def _describe(name: str, df: pd.DataFrame) -> str:
+    lines = [f"Tableau « {name} » : {len(df):,} lignes × {df.shape[1]} colonnes".replace(",", " "),
+             "Colonnes :"]
+    for c in df.columns:
+        s = df[c]
+        if pd.api.types.is_numeric_dtype(s) and s.notna().any():
+            lines.append(f"- {c} ({s.dtype}) min {s.min()}, max {s.max()}, moyenne {s.mean():.4g}")
+        else:
+            ex = ", ".join(map(str, s.dropna().unique()[:5]))
+            lines.append(f"- {c} ({s.dtype}, {s.nunique()} valeurs distinctes) ex : {ex}")
+    lines += ["Aperçu (5 premières lignes) :", df.head(5).to_csv(index=False)]
+    return "\n".join(lines)
+
+def store_table(name: str, file_bytes: bytes) -> dict:
+    """
+    Range le tableau en Parquet (si absent) et retourne
+    {"text": texte du document, "table": métadonnées à persister}.
+    """
+    key = hashlib.sha256(file_bytes).hexdigest()
+    df  = _read(file_bytes)
+    TABLE_DIR.mkdir(parents=True, exist_ok=True)
+    if not _path(key).exists():
+        tmp = _path(key).with_suffix(".tmp")
+        df.to_parquet(tmp, index=False)
+        os.replace(tmp, _path(key))
+
+    schema = _describe(name, df)
+    text   = schema
+    if len(df) <= TEXT_MAX_ROWS:
+        text += "\n\nDonnées :\n" + df.to_csv(index=False)
+    return {
+        "text": text,
+        "table": {
+            "key":     key,
+            "rows":    int(len(df)),
+            "columns": {c: str(t) for c, t in df.dtypes.items()},
+            "schema":  schema,
+        },
+    }
+
+# ──────────────────────────── requête
+def _check_columns(cols: List[str], known: dict) -> None:
+    unknown = [c for c in cols if c not in known]
+    if unknown:
+        raise ValueError(f"Colonnes inconnues : {unknown}")
+
+def _coerce(col: pd.Series, val, name: str):
+    """Valeur(s) du plan (souvent du texte) → type de la colonne ; ValueError sinon."""
+    if pd.api.types.is_bool_dtype(col):
+        return val
+    if pd.api.types.is_numeric_dtype(col):
+        convert = lambda v: pd.to_numeric(pd.Series(v, dtype=object), errors="coerce")
+    elif pd.api.types.is_datetime64_any_dtype(col):
+        convert = lambda v: pd.to_datetime(pd.Series(v, dtype=object), errors="coerce")
+    else:
+        return val
+    vals = val if isinstance(val, list) else [val]
+    out  = convert(vals)
+    if out.isna().any():
+        raise ValueError(f"Valeur {val!r} incompatible avec la colonne {name} ({col.dtype})")
+    return out.tolist() if isinstance(val, list) else out.iloc[0]
+
+def run_query(table: dict, plan: dict, max_rows: int = RESULT_MAX_ROWS) -> str:
+    """
+    Exécute un plan validé :
+      {"columns": [...], "filters": [{"column","op","value"}],
+       "group_by": [...], "aggregations": [{"column","func"}],
+       "sort": {"column","desc"}, "limit": n}
+    Retourne un CSV compact (≤ max_rows lignes) précédé du nb de lignes.
+    Plan invalide (colonne, opérateur, valeur non convertible) → ValueError.
+    """
+    known   = table["columns"]
+    filters = plan.get("filters") or []
+    groups  = plan.get("group_by") or []
+    aggs    = plan.get("aggregations") or []
+    columns = plan.get("columns") or []
+
+    for a in aggs:
+        if a.get("func") not in _AGGS:
+            raise ValueError(f"Agrégat non supporté : {a.get('func')}")
+    for f in filters:
+        if f.get("op") not in _OPS:
+            raise ValueError(f"Opérateur non supporté : {f.get('op')}")
+    needed = {f["column"] for f in filters} | set(groups) | set(columns) \
+           | {a["column"] for a in aggs if a["column"] != "*"}
+    _check_columns(sorted(needed), known)
+
+    df = pd.read_parquet(_path(table["key"]), columns=sorted(needed) or None)
+
+    for f in filters:
+        col, op, val = df[f["column"]], f["op"], f.get("value")
+        if op != "contains":
+            val = _coerce(col, val, f["column"])
+        if   op == "contains": mask = col.astype("string").str.contains(str(val), case=False, na=False)
+        elif op == "in":       mask = col.isin(val if isinstance(val, list) else [val])
+        else:                  mask = getattr(col, _CMP[op])(val)
+        df = df[mask]
+    matched = len(df)
+
+    def _agg_name(a: dict) -> str:
+        return f"{a['func']}_{'lignes' if a['column'] == '*' else a['column']}"
+
+    if aggs and groups:
+        spec = {_agg_name(a): (groups[0] if a["column"] == "*" else a["column"],
+                               "size" if a["column"] == "*" else a["func"]) for a in aggs}
+        res = df.groupby(groups, dropna=False).agg(**spec).reset_index()
+    elif aggs:
+        res = pd.DataFrame([{
+            _agg_name(a): len(df) if a["column"] == "*" else df[a["column"]].agg(a["func"])
+            for a in aggs
+        }])
+    else:
+        res = df[columns] if columns else df
+
+    sort = plan.get("sort") or {}
+    if sort.get("column") in res.columns:
+        res = res.sort_values(sort["column"], ascending=not sort.get("desc", False))
+
+    limit = min(int(plan.get("limit") or max_rows), max_rows)
+    return (f"{matched} ligne(s) correspondent aux filtres ; "
+            f"résultat ({min(limit, len(res))}/{len(res)} lignes) :\n"
+            + res.head(limit).to_csv(index=False))
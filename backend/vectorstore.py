@@ -0,0 +1,299 @@
+"""
+Index RAG persistant – adressé par contenu
+──────────────────────────────────────────
+Chaque document est découpé + vectorisé UNE seule fois ; le résultat est
+rangé sur disque sous INDEX_DIR/<clé>/ :
+
+    chunks.json   – textes des morceaux
+    offsets.json  – [début, fin] de chaque morceau dans le texte (citations)
+    vectors.npy   – embeddings float32 (n × dim), normalisés L2
+    codes.npy     – mêmes vecteurs quantifiés int8 (+ scales.npy), cf. quant.py
+    lexical.json  – index inversé BM25 sur les mêmes morceaux
+
+La clé = sha256(version index + modèle d’embedding + texte) : deux uploads
+du même contenu partagent le même index.  Les vecteurs sont chargés à la
+demande (mmap) ; au tour de chat on ne vectorise plus que la question,
+et plus rien du tout pour une requête « mots-clés » (voie lexicale seule).
+"""
+
+from __future__ import annotations
+
+import os, json, hashlib, shutil, tempfile, threading, logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, List
+
+import numpy as np
+
+from backend.models import chunk_text, embed_texts, embed_query, EMBED_MODEL
+from backend.lexical import LexicalIndex, bm25_search, is_keyword_query, rrf_fuse
+from backend import quant
+from backend.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+INDEX_DIR     = Path(os.getenv("RAG_INDEX_DIR", Path(tempfile.gettempdir()) / "klint_index"))
+INDEX_VERSION = "v2"          # ⇐ à incrémenter si le découpage change (v2 : morceaux en tokens)
+
+# ──────────────────────────── clé de contenu
+def content_key(text: str) -> str:
+    h = hashlib.sha256(f"{INDEX_VERSION}|{EMBED_MODEL}\n".encode())
+    h.update(text.encode("utf-8", errors="ignore"))
+    return h.hexdigest()
+
+# ──────────────────────────── index d’un document
+@dataclass(frozen=True)
+class DocIndex:
+    key:     str
+    chunks:  List[str]
+    vectors: np.ndarray        # (n, dim) float32, mmap – re-classement exact
+    codes:   np.ndarray        # (n, dim) int8,    mmap – balayage
+    scales:  np.ndarray        # (n,)     float32, mmap
+    lexical: LexicalIndex
+    offsets: List[List[int]] | None = None   # absent des index v1
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+def _dir(key: str) -> Path:
+    return INDEX_DIR / key[:2] / key
+
+_LOADED: "OrderedDict[str, DocIndex]" = OrderedDict()
+_LOADED_MAX = 512
+_lock_loaded = threading.Lock()
+
+def load_index(key: str) -> DocIndex | None:
+    """Charge (paresseusement, via mmap) un index déjà construit."""
+    with _lock_loaded:
+        idx = _LOADED.get(key)
+        if idx is not None:
+            _LOADED.move_to_end(key)
+            return idx
+    d = _dir(key)
+    try:
+        chunks  = json.loads((d / "chunks.json").read_text(encoding="utf-8"))
+        vectors = np.load(d / "vectors.npy", mmap_mode="r")
+    except FileNotFoundError:
+        return None
+    try:
+        lexical = LexicalIndex.from_json(json.loads((d / "lexical.json").read_text(encoding="utf-8")))
+    except FileNotFoundError:                      # index antérieur au BM25
+        lexical = LexicalIndex.build(chunks)
+        _write_json(d / "lexical.json", lexical.to_json())
+    if not (d / "codes.npy").exists():             # index antérieur à l’int8
+        _write_codes(d, np.asarray(vectors))
+    codes  = np.load(d / "codes.npy",  mmap_mode="r")
+    scales = np.load(d / "scales.npy", mmap_mode="r")
+    offsets_path = d / "offsets.json"
+    offsets = json.loads(offsets_path.read_text(encoding="utf-8")) if offsets_path.exists() else None
+    idx = DocIndex(key, chunks, vectors, codes, scales, lexical, offsets)
+    with _lock_loaded:
+        _LOADED[key] = idx
+        while len(_LOADED) > _LOADED_MAX:
+            _LOADED.popitem(last=False)
+    return idx
+
+def _write_json(path: Path, data) -> None:
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp, path)
+
+def _write_codes(d: Path, vectors: np.ndarray) -> None:
+    codes, scales = quant.quantize(vectors)
+    for name, arr in (("scales", scales), ("codes", codes)):   # codes en dernier
+        np.save(d / f".{name}.tmp.npy", arr)
+        os.replace(d / f".{name}.tmp.npy", d / f"{name}.npy")
+
+def _save(key: str, chunks: list[str], offsets: list[list[int]], vectors: np.ndarray) -> None:
+    """Écriture atomique : dossier temporaire puis rename."""
+    final = _dir(key)
+    final.parent.mkdir(parents=True, exist_ok=True)
+    tmp = Path(tempfile.mkdtemp(dir=final.parent, prefix=".tmp-"))
+    try:
+        _write_json(tmp / "chunks.json", chunks)
+        _write_json(tmp / "offsets.json", offsets)
+        _write_json(tmp / "lexical.json", LexicalIndex.build(chunks).to_json())
+        np.save(tmp / "vectors.npy", vectors)
+        _write_codes(tmp, vectors)
+        os.replace(tmp, final)
+    except OSError:
+        # un autre worker a gagné la course : son index est identique
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def _normalize(mat: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(mat, axis=-1, keepdims=True)
+    return mat / np.maximum(norms, 1e-12)
+
+# verrous « rayés » : taille fixe, une clé de contenu → toujours le même verrou
+_BUILD_LOCKS = [threading.Lock() for _ in range(64)]
+
+def ensure_index(text: str) -> DocIndex | None:
+    """
+    Retourne l’index du texte ; ne découpe / vectorise que s’il n’existe pas
+    encore sur disque.  None si le texte est vide.
+    """
+    if not text.strip():
+        return None
+    key = content_key(text)
+    idx = load_index(key)
+    if idx is not None:
+        return idx
+
+    with _BUILD_LOCKS[int(key[:8], 16) % len(_BUILD_LOCKS)]:
+        idx = load_index(key)             # construit entre-temps ?
+        if idx is not None:
+            return idx
+        pieces = chunk_text(text)
+        if not pieces:
+            return None
+        chunks  = [p.text for p in pieces]
+        vectors = _normalize(np.asarray(embed_texts(chunks), dtype=np.float32))
+        _save(key, chunks, [[p.start, p.end] for p in pieces], vectors)
+        logger.info("Index %s construit (%d morceaux)", key[:12], len(chunks))
+        return load_index(key)
+
+# ──────────────────────────── ingestion (à l’upload)
+def ingest_document(text: str) -> dict:
+    """
+    Découpe + vectorise dès l’upload.  Retourne les métadonnées à ranger
+    à côté du document : {"status", "index": {"key", "n_chunks"}} – les
+    identifiants de morceaux se déduisent de là (cf. chunk_ids), rien de
+    proportionnel au document n’est persisté dans Cosmos.
+    En cas d’échec le document reste « pending » et sera indexé au 1er tour.
+    """
+    if not text.strip():
+        return {"status": "empty"}
+    try:
+        idx = ensure_index(text)
+    except Exception:
+        logger.exception("Indexation à l’upload impossible")
+        return {"status": "pending"}
+    if idx is None:
+        return {"status": "empty"}
+    return {
+        "status": "ready",
+        "index": {"key": idx.key, "n_chunks": len(idx)},
+    }
+
+def chunk_ids(index: dict) -> list[str]:
+    """Identifiants stables des morceaux (« <clé[:16]>:<n° = ligne du vecteur> »)."""
+    n = index.get("n_chunks", len(index.get("chunk_ids", ())))     # entrées antérieures
+    return [f"{index['key'][:16]}:{i}" for i in range(n)]
+
+def _doc_index(doc: dict) -> DocIndex | None:
+    """Lookup pur si le document a été indexé à l’upload, sinon rattrapage."""
+    key = (doc.get("index") or {}).get("key")
+    if doc.get("status") == "ready" and key:
+        idx = load_index(key)
+        if idx is not None:
+            return idx
+    return ensure_index(doc.get("content", ""))
+
+# ──────────────────────────── recherche multi-documents
+@dataclass(frozen=True)
+class VectorStore:
+    """Vue (immuable) sur plusieurs index de documents."""
+    indexes: tuple[DocIndex, ...]
+    version: str = ""
+
+    def __bool__(self) -> bool:
+        return any(len(i) for i in self.indexes)
+
+    def __add__(self, other: "VectorStore") -> "VectorStore":
+        return VectorStore(self.indexes + other.indexes, f"{self.version}+{other.version}")
+
+def _version(indexes: Iterable[DocIndex]) -> str:
+    return hashlib.sha1("|".join(i.key for i in indexes).encode()).hexdigest()[:16]
+
+def build_vectorstore(docs: Iterable[dict]) -> VectorStore:
+    """Un index par document (construit à l’upload, ou à défaut maintenant)."""
+    indexes = tuple(i for i in map(_doc_index, docs) if i is not None)
+    return VectorStore(indexes, _version(indexes))
+
+# ──────────────────────────── index de projet (partagé, versionné)
+#  Un snapshot immuable par projet, partagé par toutes ses conversations.
+#  Version = empreinte des clés d’index (triées) de `proj["files"]` : deux
+#  workers, ou deux uploads concurrents, qui voient les mêmes fichiers ont
+#  la même version ; une requête en cours garde le snapshot qu’elle a obtenu.
+_lock_projects = threading.Lock()
+_PROJECTS: dict[str, VectorStore] = {}
+
+def _doc_key(doc: dict) -> str:
+    return (doc.get("index") or {}).get("key") or content_key(doc.get("content", ""))
+
+def _project_version(proj: dict) -> str:
+    keys = sorted({_doc_key(f) for f in proj.get("files", [])})
+    return f"{proj['id']}@{hashlib.sha1('|'.join(keys).encode()).hexdigest()[:16]}"
+
+def project_store(proj: dict) -> VectorStore:
+    """
+    Snapshot de l’index du projet pour ses fichiers actuels. Incrémental :
+    les index déjà dans le snapshot précédent sont repris, seuls les
+    nouveaux fichiers sont chargés (ou indexés s’ils sont « pending »).
+    """
+    version = _project_version(proj)
+    with _lock_projects:
+        snap = _PROJECTS.get(proj["id"])
+    if snap is not None and snap.version == version:
+        return snap
+    have = {i.key: i for i in snap.indexes} if snap is not None else {}
+    indexes, seen = [], set()
+    for f in proj.get("files", []):
+        key = _doc_key(f)
+        if key in seen:
+            continue
+        seen.add(key)
+        idx = have.get(key) or _doc_index(f)
+        if idx is not None:
+            indexes.append(idx)
+    snap = VectorStore(tuple(indexes), version)
+    with _lock_projects:
+        _PROJECTS[proj["id"]] = snap
+    return snap
+
+# ──────────────────────────── caches (questions reformulées / régénérées)
+_QUERY_VECTORS = TTLCache("query_embeddings", maxsize=2_048, ttl=24 * 3600)   # ≈ 6 Ko / entrée
+_RESULTS       = TTLCache("retrieval_results", maxsize=1_024, ttl=600)
+
+def _norm_query(query: str) -> str:
+    return " ".join(query.casefold().split())
+
+def _query_vector(query: str) -> np.ndarray:
+    key = (EMBED_MODEL, _norm_query(query))
+    return _QUERY_VECTORS.get_or_set(
+        key, lambda: _normalize(np.asarray(embed_query(query), dtype=np.float32)))
+
+def _vector_search(vs: VectorStore, query: str, k: int) -> list[tuple[int, int]]:
+    """[(n° index, n° morceau)] par similarité cosinus décroissante."""
+    q = _query_vector(query)
+
+    # top-k par document (int8 + re-classement float) puis fusion
+    scored: list[tuple[float, int, int]] = []
+    for d, idx in enumerate(vs.indexes):
+        ids, sims = quant.search(idx.vectors, idx.codes, idx.scales, q, k)
+        scored += [(float(s), d, int(i)) for i, s in zip(ids, sims)]
+
+    scored.sort(reverse=True)
+    return [(d, i) for _, d, i in scored[:k]]
+
+def search_documents(vs: VectorStore, query: str, k: int = 4) -> list[str]:
+    """
+    Recherche hybride : BM25 local + vecteurs, fusionnés par RRF.
+    Requête courte « mots-clés » avec résultats lexicaux → pas d’embedding.
+    Résultats mis en cache par (version d’index, question normalisée, k).
+    """
+    if not vs or not query.strip():
+        return []
+    key = (vs.version, _norm_query(query), k)
+    return list(_RESULTS.get_or_set(key, lambda: _search(vs, query, k)))
+
+def _search(vs: VectorStore, query: str, k: int) -> tuple[str, ...]:
+    depth   = max(20, 5 * k)
+    lexical = [(d, c) for _, d, c in bm25_search([i.lexical for i in vs.indexes], query, k=depth)]
+
+    if lexical and is_keyword_query(query):
+        ranked = lexical
+    else:
+        ranked = rrf_fuse([lexical, _vector_search(vs, query, depth)])
+    return tuple(vs.indexes[d].chunks[c] for d, c in ranked[:k])